@@ -1,8 +1,20 @@
 from builtins import range
 from builtins import object
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import warnings
+import weakref
 import numpy as np
 from past.builtins import xrange
 
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
 
 class KNearestNeighbor(object):
     """ a kNN classifier with L2 distance """
@@ -10,7 +22,7 @@ class KNearestNeighbor(object):
     def __init__(self):
         pass
 
-    def train(self, X, y):
+    def train(self, X, y, index=None, compute_dtype=None):
         """
         Train the classifier. For k-nearest neighbors this is just
         memorizing the training data.
@@ -20,11 +32,81 @@ class KNearestNeighbor(object):
           consisting of num_train samples each of dimension D.
         - y: A numpy array of shape (N,) containing the training labels, where
              y[i] is the label for X[i].
+        - index: Optional approximate nearest neighbor index, such as an
+          IVFIndex. It is built once here and then used by predict.
+        - compute_dtype: Optional reduced precision dtype, np.float32 or
+          np.float16. If given, a copy of X in this dtype is kept and used by
+          predict(..., dtype=compute_dtype).
         """
         self.X_train = X
         self.y_train = y
+        self.index = index
+        self._shared_dir = None
+        # squared row norms are needed by every distance computation, so
+        # compute them once here instead of on every call
+        self.train_sq_norms = _row_sq_norms(X)
+        self.X_train_lowp = None
+        self.train_sq_norms_lowp = None
+        if compute_dtype is not None:
+            self.X_train_lowp = X.astype(compute_dtype)
+            self.train_sq_norms_lowp = _row_sq_norms(self.X_train_lowp)
+        if index is not None:
+            index.build(X)
+
+    def train_from_store(self, path, index=None):
+        """
+        Train the classifier from a reference store written by save_store.
+
+        The arrays are memory-mapped rather than read, so training is nearly
+        instant, every process using the same store shares one copy of the data
+        through the page cache, and the data may be larger than RAM. In that
+        case use predict with max_block_bytes, which streams over the training
+        rows one tile at a time.
+
+        Inputs:
+        - path: Directory of the store.
+        - index: Optional approximate nearest neighbor index; see train.
+        """
+        arrays = {}
+        for name in _SHARED_ARRAYS:
+            file_name = os.path.join(path, name + '.npy')
+            arrays[name] = (np.load(file_name, mmap_mode='r')
+                            if os.path.exists(file_name) else None)
+        if arrays['X_train'] is None or arrays['y_train'] is None:
+            raise ValueError('%s is not a reference store' % path)
 
-    def predict(self, X, k=1, num_loops=0):
+        self.X_train = arrays['X_train']
+        self.y_train = arrays['y_train']
+        self.train_sq_norms = arrays['train_sq_norms']
+        if self.train_sq_norms is None:
+            self.train_sq_norms = _row_sq_norms(self.X_train)
+        self.X_train_lowp = arrays['X_train_lowp']
+        self.train_sq_norms_lowp = arrays['train_sq_norms_lowp']
+        if self.X_train_lowp is not None and self.train_sq_norms_lowp is None:
+            self.train_sq_norms_lowp = _row_sq_norms(self.X_train_lowp)
+        self.index = index
+        self._shared_dir = path
+        if index is not None:
+            index.build(self.X_train)
+
+    def save_store(self, path):
+        """
+        Write the training data of this classifier to a reference store: a
+        directory holding X_train.npy, y_train.npy and the cached norms and
+        reduced precision copy, if any, as .npy files that train_from_store can
+        memory-map.
+
+        Inputs:
+        - path: Directory of the store; it is created if needed.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in _SHARED_ARRAYS:
+            if getattr(self, name) is not None:
+                np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+    def predict(self, X, k=1, num_loops=0, max_block_bytes=None,
+                num_probes=None, dtype=None):
         """
         Predict labels for test data using this classifier.
 
@@ -34,13 +116,32 @@ class KNearestNeighbor(object):
         - k: The number of nearest neighbors that vote for the predicted labels.
         - num_loops: Determines which implementation to use to compute distances
           between training points and testing points.
+        - max_block_bytes: If given, use compute_topk_blocked with this byte
+          budget instead of building the full distance matrix; num_loops is
+          then ignored.
+        - num_probes: Number of index cells visited per query when an index was
+          given to train; defaults to the index's own setting.
+        - dtype: Optional dtype such as np.float32 for the no-loop and blocked
+          distance computations. Half precision data is stored as float16 but
+          computed in float32.
 
         Returns:
         - y: A numpy array of shape (num_test,) containing predicted labels for the
           test data, where y[i] is the predicted label for the test point X[i].
         """
+        if self.index is not None:
+            _, inds = self.index.search(self.X_train, X, k=k,
+                                        num_probes=num_probes)
+            return self.vote_labels(np.where(inds >= 0, self.y_train[inds], -1))
+
+        if max_block_bytes is not None:
+            _, inds = self.compute_topk_blocked(X, k=k,
+                                                max_block_bytes=max_block_bytes,
+                                                dtype=dtype)
+            return self.vote_labels(self.y_train[inds])
+
         if num_loops == 0:
-            dists = self.compute_distances_no_loops(X)
+            dists = self.compute_distances_no_loops(X, dtype=dtype)
         elif num_loops == 1:
             dists = self.compute_distances_one_loop(X)
         elif num_loops == 2:
@@ -50,6 +151,139 @@ class KNearestNeighbor(object):
 
         return self.predict_labels(dists, k=k)
 
+    def predict_parallel(self, X, k=1, num_workers=None, num_shards=None,
+                         **kwargs):
+        """
+        Predict labels for test data using a pool of worker processes.
+
+        The test points are split into contiguous shards which are predicted
+        independently and concatenated back in order. The workers do not receive
+        a pickled copy of the training data: it is written once to .npy files,
+        or taken from the reference store it was trained from, and every worker
+        memory-maps them, so all processes share the same pages. Each worker
+        limits its BLAS to a single thread with threadpoolctl; without it a
+        warning is issued, and OMP_NUM_THREADS=1 must be set before Python
+        starts to avoid oversubscribing the cores.
+
+        Inputs:
+        - X: A numpy array of shape (num_test, D) containing test data.
+        - k: The number of nearest neighbors that vote for the predicted labels.
+        - num_workers: Number of processes; defaults to the number of CPUs.
+        - num_shards: Number of shards X is split into; defaults to four per
+          worker so that uneven shards balance out.
+        - kwargs: Any other keyword arguments of predict.
+
+        Returns:
+        - y: A numpy array of shape (num_test,) containing predicted labels.
+        """
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        if num_shards is None:
+            num_shards = 4 * num_workers
+        num_shards = max(1, min(num_shards, X.shape[0]))
+        kwargs['k'] = k
+
+        if threadpool_limits is None:
+            warnings.warn('threadpoolctl is not installed, so the BLAS thread '
+                          'count of the prediction workers cannot be limited')
+        shared_dir = self._share_training_data()
+        shards = np.array_split(X, num_shards)
+        pool = multiprocessing.Pool(num_workers, initializer=_init_worker,
+                                    initargs=(shared_dir, self.index))
+        try:
+            y_preds = pool.map(_predict_shard, [(s, kwargs) for s in shards],
+                               chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return np.concatenate(y_preds)
+
+    def cross_validate(self, X, y, k_choices, num_folds=5,
+                       max_block_bytes=2**26, dtype=None):
+        """
+        Estimate the accuracy of every candidate k by num_folds-fold cross
+        validation.
+
+        Distances only depend on the fold, not on k, so each fold's distances
+        are computed once: only the indices of the max(k_choices) nearest
+        neighbors of every held-out point are kept, as a compact int32 array,
+        and every k is then scored by voting over a prefix of that cache.
+
+        Inputs:
+        - X: A numpy array of shape (N, D) containing the data to split in folds.
+        - y: A numpy array of shape (N,) containing the labels of X.
+        - k_choices: List of candidate values of k.
+        - num_folds: Number of folds.
+        - max_block_bytes, dtype: See compute_topk_blocked.
+
+        Returns:
+        - k_to_accuracies: A dictionary mapping each k in k_choices to a list of
+          num_folds accuracies, one per held-out fold.
+        """
+        X_folds = np.array_split(X, num_folds)
+        y_folds = np.array_split(y, num_folds)
+        max_k = max(k_choices)
+        k_to_accuracies = {k: [] for k in k_choices}
+
+        for fold in range(num_folds):
+            y_train = np.concatenate(y_folds[:fold] + y_folds[fold + 1:])
+            classifier = KNearestNeighbor()
+            classifier.train(np.concatenate(X_folds[:fold] + X_folds[fold + 1:]),
+                             y_train, compute_dtype=dtype)
+            _, inds = classifier.compute_topk_blocked(
+                X_folds[fold], k=max_k, max_block_bytes=max_block_bytes,
+                dtype=dtype)
+            neighbors = inds.astype(np.int32)
+            del inds, classifier
+
+            # neighbors are sorted by distance, so the first k columns are the
+            # k nearest neighbors for every k <= max_k
+            closest_y = y_train[neighbors]
+            for k in k_choices:
+                y_pred = self.vote_labels(closest_y[:, :k])
+                k_to_accuracies[k].append(np.mean(y_pred == y_folds[fold]))
+
+        return k_to_accuracies
+
+    def _share_training_data(self):
+        """
+        Return the directory of a reference store holding the training data,
+        writing one to a temporary directory the first time if the classifier
+        was not trained from a store. A temporary store is removed when the
+        classifier is garbage collected.
+        """
+        if self._shared_dir is None:
+            shared_dir = tempfile.mkdtemp(prefix='knn_')
+            weakref.finalize(self, shutil.rmtree, shared_dir, True)
+            self.save_store(shared_dir)
+            self._shared_dir = shared_dir
+        return self._shared_dir
+
+    def index_recall(self, X, k=1, num_probes=None):
+        """
+        Measure how well the approximate index approximates exact search.
+
+        Inputs:
+        - X: A numpy array of shape (num_test, D) containing test data.
+        - k: Number of neighbors to compare.
+        - num_probes: Number of index cells visited per query.
+
+        Returns a tuple of:
+        - recall: Fraction of the exact k nearest neighbors, as found with
+          compute_distances_no_loops, that the index also returns.
+        - queries_per_second: Throughput of the index search on X.
+        """
+        if self.index is None:
+            raise ValueError('No index was given to train')
+        start = time.time()
+        _, approx = self.index.search(self.X_train, X, k=k,
+                                      num_probes=num_probes)
+        elapsed = time.time() - start
+
+        exact = _smallest_k(self.compute_distances_no_loops(X), k)
+        found = (exact[:, :, np.newaxis] == approx[:, np.newaxis, :]).any(axis=2)
+        return found.mean(), X.shape[0] / max(elapsed, 1e-12)
+
     def compute_distances_two_loops(self, X):
         """
         Compute the distance between each test point in X and each training point
@@ -104,16 +338,17 @@ class KNearestNeighbor(object):
             # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
         return dists
 
-    def compute_distances_no_loops(self, X):
+    def compute_distances_no_loops(self, X, dtype=None):
         """
         Compute the distance between each test point in X and each training point
         in self.X_train using no explicit loops.
 
-        Input / Output: Same as compute_distances_two_loops
+        Input / Output: Same as compute_distances_two_loops, except for
+        - dtype: Optional dtype of the computation; see predict.
         """
-        num_test = X.shape[0]
-        num_train = self.X_train.shape[0]
-        dists = np.zeros((num_test, num_train))
+        compute_dtype = self._compute_dtype(X, dtype)
+        X_train, train_sq_norms = self._training_rows(0, None, dtype,
+                                                      compute_dtype)
         #########################################################################
         # TODO:                                                                 #
         # Compute the l2 distance between all test points and all training      #
@@ -128,11 +363,144 @@ class KNearestNeighbor(object):
         #       and two broadcast sums.                                         #
         #########################################################################
         # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
-        dists = np.sqrt(np.expand_dims(np.sum(X**2, axis=1), axis=1) + np.expand_dims(np.sum(self.X_train**2, axis=1), axis=0) - 2*np.dot(X, self.X_train.T))
+        X = X.astype(compute_dtype, copy=False)
+        dists = np.dot(X, X_train.T)
+        dists *= -2
+        dists += np.expand_dims(np.einsum('ij,ij->i', X, X), axis=1)
+        dists += train_sq_norms
+        # cancellation can make squared distances slightly negative
+        np.maximum(dists, 0, out=dists)
+        np.sqrt(dists, out=dists)
 
         # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
         return dists
 
+    def compute_topk_blocked(self, X, k=1, max_block_bytes=2**26, dtype=None):
+        """
+        Find the k nearest training points of each test point without ever
+        building the full (num_test, num_train) distance matrix.
+
+        Test and training rows are processed in tiles small enough that one
+        tile of squared distances (plus the indices used to select from it)
+        fits in max_block_bytes. A single scratch buffer is allocated up front
+        and reused for every tile, and each tile is immediately reduced to its
+        k best candidates, which are merged into a running (num_test, k) result.
+        Peak memory therefore scales with the tile size rather than with
+        num_test * num_train.
+
+        Inputs:
+        - X: A numpy array of shape (num_test, D) containing test data.
+        - k: The number of nearest neighbors to return for each test point.
+        - max_block_bytes: Approximate upper bound in bytes on the memory used
+          for a single tile.
+        - dtype: Optional dtype of the computation; see predict.
+
+        Returns a tuple of:
+        - dists: A numpy array of shape (num_test, k) where dists[i] holds the
+          distances from the ith test point to its k nearest training points,
+          sorted in increasing order.
+        - inds: An integer array of shape (num_test, k) giving the indices into
+          self.X_train of those training points.
+        """
+        num_test = X.shape[0]
+        num_train = self.X_train.shape[0]
+        if not 1 <= k <= num_train:
+            raise ValueError('Invalid value %d for k' % k)
+        requested_dtype = dtype
+        dtype = self._compute_dtype(X, dtype)
+        block_test, block_train = _tile_shape(num_test, num_train, k,
+                                              dtype.itemsize + 8,
+                                              max_block_bytes)
+
+        scratch = np.empty(block_test * block_train, dtype=dtype)
+        dists = np.empty((num_test, k), dtype=dtype)
+        inds = np.empty((num_test, k), dtype=np.int64)
+
+        for t0 in range(0, num_test, block_test):
+            X_block = X[t0:t0 + block_test].astype(dtype, copy=False)
+            num_rows = X_block.shape[0]
+            test_sq = np.einsum('ij,ij->i', X_block, X_block)
+            best_d = np.empty((num_rows, 0), dtype=dtype)
+            best_i = np.empty((num_rows, 0), dtype=np.int64)
+
+            for s0 in range(0, num_train, block_train):
+                train_block, train_sq = self._training_rows(
+                    s0, s0 + block_train, requested_dtype, dtype)
+                num_cols = train_block.shape[0]
+
+                # squared distances for this tile, computed in the scratch buffer
+                tile = scratch[:num_rows * num_cols].reshape(num_rows, num_cols)
+                np.dot(X_block, train_block.T, out=tile)
+                tile *= -2
+                tile += test_sq[:, np.newaxis]
+                tile += train_sq
+                np.maximum(tile, 0, out=tile)
+
+                cand_i = _smallest_k(tile, k) + s0
+                cand_d = np.take_along_axis(tile, cand_i - s0, axis=1)
+                best_d = np.hstack((best_d, cand_d))
+                best_i = np.hstack((best_i, cand_i))
+                if best_d.shape[1] > k:
+                    keep = _smallest_k(best_d, k)
+                    best_d = np.take_along_axis(best_d, keep, axis=1)
+                    best_i = np.take_along_axis(best_i, keep, axis=1)
+
+            order = np.argsort(best_d, axis=1, kind='stable')
+            dists[t0:t0 + num_rows] = np.take_along_axis(best_d, order, axis=1)
+            inds[t0:t0 + num_rows] = np.take_along_axis(best_i, order, axis=1)
+
+        np.sqrt(dists, out=dists)
+        return dists, inds
+
+    def _compute_dtype(self, X, dtype):
+        """
+        The floating point dtype distances are computed in. Without an explicit
+        dtype this follows the inputs; float16 is only a storage format and is
+        computed in float32.
+        """
+        if dtype is None:
+            return np.result_type(X.dtype, self.X_train.dtype, np.float32)
+        return np.result_type(dtype, np.float32)
+
+    def _training_rows(self, start, stop, dtype, compute_dtype):
+        """
+        Return training rows [start, stop) and their cached squared norms cast
+        to compute_dtype. The reduced precision copy made by train is used when
+        its dtype is the requested dtype.
+        """
+        if (dtype is not None and self.X_train_lowp is not None
+                and np.dtype(dtype) == self.X_train_lowp.dtype):
+            X_train, sq_norms = self.X_train_lowp, self.train_sq_norms_lowp
+        else:
+            X_train, sq_norms = self.X_train, self.train_sq_norms
+        return (X_train[start:stop].astype(compute_dtype, copy=False),
+                sq_norms[start:stop].astype(compute_dtype, copy=False))
+
+    def vote_labels(self, closest_y):
+        """
+        Majority vote over the labels of the nearest neighbors of each test
+        point, breaking ties by choosing the smaller label.
+
+        Inputs:
+        - closest_y: A numpy array of shape (num_test, k) where closest_y[i]
+          holds the labels of the k nearest neighbors of the ith test point.
+          Negative entries mark missing neighbors and cast no vote.
+
+        Returns:
+        - y: A numpy array of shape (num_test,) containing predicted labels.
+        """
+        num_test, k = closest_y.shape
+        num_labels = int(closest_y.max()) + 1 if closest_y.size else 1
+        # count the votes of every test point at once by offsetting each row's
+        # labels into its own block of num_labels bins
+        offsets = num_labels * np.arange(num_test)[:, np.newaxis]
+        votes = closest_y >= 0
+        counts = np.bincount((np.where(votes, closest_y, 0) + offsets).ravel(),
+                             weights=votes.ravel(),
+                             minlength=num_test * num_labels)
+        # argmax returns the first maximum, i.e. the smallest tied label
+        return np.argmax(counts.reshape(num_test, num_labels), axis=1)
+
     def predict_labels(self, dists, k=1):
         """
         Given a matrix of distances between test points and training points,
@@ -146,34 +514,88 @@ class KNearestNeighbor(object):
         - y: A numpy array of shape (num_test,) containing predicted labels for the
           test data, where y[i] is the predicted label for the test point X[i].
         """
-        num_test = dists.shape[0]
-        y_pred = np.zeros(num_test)
-        for i in range(num_test):
-            # A list of length k storing the labels of the k nearest neighbors to
-            # the ith test point.
-            closest_y = []
-            #########################################################################
-            # TODO:                                                                 #
-            # Use the distance matrix to find the k nearest neighbors of the ith    #
-            # testing point, and use self.y_train to find the labels of these       #
-            # neighbors. Store these labels in closest_y.                           #
-            # Hint: Look up the function numpy.argsort.                             #
-            #########################################################################
-            # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
-            closest_y = self.y_train[np.argsort(dists[i,:])[:k]]
-            # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
-            #########################################################################
-            # TODO:                                                                 #
-            # Now that you have found the labels of the k nearest neighbors, you    #
-            # need to find the most common label in the list closest_y of labels.   #
-            # Store this label in y_pred[i]. Break ties by choosing the smaller     #
-            # label.                                                                #
-            #########################################################################
-            # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
-            distinct_labels = sorted(list(set(closest_y))) 
-            count_labels = [np.sum(closest_y == label) for label in distinct_labels]
-            y_pred[i] = distinct_labels[np.argmax(count_labels)]
+        #########################################################################
+        # TODO:                                                                 #
+        # Use the distance matrix to find the k nearest neighbors of the ith    #
+        # testing point, and use self.y_train to find the labels of these       #
+        # neighbors. Store these labels in closest_y.                           #
+        # Hint: Look up the function numpy.argsort.                             #
+        #########################################################################
+        # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
+        # a partial sort over all rows at once is enough: the order of the k
+        # nearest neighbors among themselves does not matter for the vote
+        closest_y = self.y_train[_smallest_k(dists, k)]
+        # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
+        #########################################################################
+        # TODO:                                                                 #
+        # Now that you have found the labels of the k nearest neighbors, you    #
+        # need to find the most common label in the list closest_y of labels.   #
+        # Store this label in y_pred[i]. Break ties by choosing the smaller     #
+        # label.                                                                #
+        #########################################################################
+        # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
+        y_pred = self.vote_labels(closest_y)
 
-            # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
+        # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
 
         return y_pred
+
+
+# Arrays of a trained classifier that make up a reference store on disk.
+_SHARED_ARRAYS = ('X_train', 'y_train', 'train_sq_norms', 'X_train_lowp',
+                  'train_sq_norms_lowp')
+
+# The classifier of a predict_parallel worker process, set by _init_worker.
+_worker_classifier = None
+
+
+def _init_worker(shared_dir, index):
+    global _worker_classifier
+    if threadpool_limits is not None:
+        threadpool_limits(1)
+    classifier = KNearestNeighbor()
+    classifier.train_from_store(shared_dir)
+    # the index was already built by the parent process
+    classifier.index = index
+    _worker_classifier = classifier
+
+
+def _predict_shard(args):
+    X, kwargs = args
+    return _worker_classifier.predict(X, **kwargs)
+
+
+def _row_sq_norms(X, block_size=4096):
+    """
+    Squared L2 norm of every row of X, accumulated in float64 over blocks of
+    rows so that no squared copy of X is ever allocated.
+    """
+    sq_norms = np.empty(X.shape[0])
+    for i in range(0, X.shape[0], block_size):
+        block = np.asarray(X[i:i + block_size], dtype=np.float64)
+        sq_norms[i:i + block_size] = np.einsum('ij,ij->i', block, block)
+    return sq_norms
+
+
+def _tile_shape(num_test, num_train, k, bytes_per_entry, max_block_bytes):
+    """
+    Choose the (test rows, train rows) shape of a distance tile so that
+    one tile takes at most max_block_bytes, keeping the tile roughly square
+    and at least k columns wide when possible.
+    """
+    max_entries = max(int(max_block_bytes) // bytes_per_entry, 1)
+    block_test = min(num_test, max(int(np.sqrt(max_entries)), 1))
+    block_train = min(num_train, max(max_entries // block_test, k))
+    block_test = min(num_test, max(max_entries // block_train, 1))
+    return max(block_test, 1), max(block_train, 1)
+
+
+def _smallest_k(a, k):
+    """
+    Return the column indices of the k smallest entries in each row of a,
+    in no particular order. If a has at most k columns all of them are kept.
+    """
+    num_rows, num_cols = a.shape
+    if num_cols <= k:
+        return np.broadcast_to(np.arange(num_cols), (num_rows, num_cols))
+    return np.argpartition(a, k - 1, axis=1)[:, :k]
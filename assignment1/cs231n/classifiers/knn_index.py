@@ -0,0 +1,149 @@
+from builtins import range
+from builtins import object
+import numpy as np
+
+from cs231n.classifiers.k_nearest_neighbor import _smallest_k
+
+
+class IVFIndex(object):
+    """
+    An inverted file (IVF) index for approximate nearest neighbor search.
+
+    The training points are clustered with k-means into num_lists cells. A
+    query only computes exact distances to the training points of the
+    num_probes cells whose centroids are closest to it, so the cost of a query
+    is roughly num_probes / num_lists of a brute force search.
+
+    Any object with the same build / search methods can be passed to
+    KNearestNeighbor.train as an index. The index only stores the centroids and
+    the cell membership of each training point; the training data itself is
+    passed to search, so the index stays small and cheap to copy.
+    """
+
+    def __init__(self, num_lists=64, num_probes=4, num_iters=10,
+                 max_train_points=50000, seed=0):
+        """
+        Inputs:
+        - num_lists: Number of k-means cells.
+        - num_probes: Default number of cells visited by each query.
+        - num_iters: Number of Lloyd iterations used to fit the centroids.
+        - max_train_points: The centroids are fit on a random subset of at most
+          this many training points; every point is then assigned to a cell.
+        - seed: Seed for the random number generator used by k-means.
+        """
+        self.num_lists = num_lists
+        self.num_probes = num_probes
+        self.num_iters = num_iters
+        self.max_train_points = max_train_points
+        self.seed = seed
+        self.centroids = None
+
+    def build(self, X):
+        """
+        Cluster the training data and build the inverted lists.
+
+        Inputs:
+        - X: A numpy array of shape (num_train, D) containing the training data.
+        """
+        num_train = X.shape[0]
+        num_lists = min(self.num_lists, num_train)
+        rng = np.random.RandomState(self.seed)
+
+        sample = X
+        if num_train > self.max_train_points:
+            sample = X[np.sort(rng.choice(num_train, self.max_train_points,
+                                          replace=False))]
+        sample = np.asarray(sample, dtype=np.float64)
+
+        centroids = sample[rng.choice(sample.shape[0], num_lists, replace=False)]
+        for it in range(self.num_iters):
+            assign = _nearest_centroid(sample, centroids)
+            counts = np.bincount(assign, minlength=num_lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            empty = counts == 0
+            centroids = sums / np.maximum(counts, 1)[:, np.newaxis]
+            # reseed empty cells with random points so no cell is wasted
+            centroids[empty] = sample[rng.choice(sample.shape[0], empty.sum())]
+        self.centroids = centroids
+
+        # store the lists in CSR form: the members of cell c are
+        # list_inds[list_offsets[c]:list_offsets[c + 1]]
+        assign = _nearest_centroid(X, centroids)
+        self.list_inds = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=num_lists)
+        self.list_offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    def search(self, X_train, X, k=1, num_probes=None):
+        """
+        Find approximate k nearest neighbors of each row of X.
+
+        Inputs:
+        - X_train: The array of shape (num_train, D) the index was built on.
+        - X: A numpy array of shape (num_test, D) containing test data.
+        - k: Number of neighbors to return.
+        - num_probes: Number of cells to visit per query; defaults to
+          self.num_probes. Visiting every cell gives the exact result.
+
+        Returns a tuple of:
+        - dists: Array of shape (num_test, k) of distances, sorted increasingly.
+        - inds: Array of shape (num_test, k) of indices into X_train. If the
+          visited cells hold fewer than k points, the missing entries have
+          distance inf and index -1.
+        """
+        if self.centroids is None:
+            raise ValueError('The index must be built before it is searched')
+        if num_probes is None:
+            num_probes = self.num_probes
+        num_lists = self.centroids.shape[0]
+        num_probes = max(1, min(num_probes, num_lists))
+        num_test = X.shape[0]
+
+        probes = _smallest_k(_sq_dists(X, self.centroids), num_probes)
+        best_d = np.full((num_test, k), np.inf)
+        best_i = np.full((num_test, k), -1, dtype=np.int64)
+
+        # visit the cells one at a time, handling every query that probes the
+        # cell together so each cell costs a single matrix multiplication
+        probe_rows = np.repeat(np.arange(num_test), probes.shape[1])
+        probe_cells = probes.ravel()
+        order = np.argsort(probe_cells, kind='stable')
+        probe_rows, probe_cells = probe_rows[order], probe_cells[order]
+        bounds = np.searchsorted(probe_cells, np.arange(num_lists + 1))
+        for c in range(num_lists):
+            rows = probe_rows[bounds[c]:bounds[c + 1]]
+            members = self.list_inds[self.list_offsets[c]:self.list_offsets[c + 1]]
+            if rows.size == 0 or members.size == 0:
+                continue
+            tile = _sq_dists(X[rows], X_train[members])
+            cand_d = np.hstack((best_d[rows], tile))
+            cand_i = np.hstack((best_i[rows],
+                                np.broadcast_to(members, tile.shape)))
+            keep = _smallest_k(cand_d, k)
+            best_d[rows] = np.take_along_axis(cand_d, keep, axis=1)
+            best_i[rows] = np.take_along_axis(cand_i, keep, axis=1)
+
+        order = np.argsort(best_d, axis=1, kind='stable')
+        best_d = np.sqrt(np.take_along_axis(best_d, order, axis=1))
+        best_i = np.take_along_axis(best_i, order, axis=1)
+        return best_d, best_i
+
+
+def _sq_dists(A, B):
+    """ Squared L2 distances between the rows of A and the rows of B. """
+    A = np.asarray(A, dtype=np.float64)
+    B = np.asarray(B, dtype=np.float64)
+    d = np.dot(A, B.T)
+    d *= -2
+    d += np.einsum('ij,ij->i', A, A)[:, np.newaxis]
+    d += np.einsum('ij,ij->i', B, B)
+    return np.maximum(d, 0, out=d)
+
+
+def _nearest_centroid(X, centroids, block_size=4096):
+    """ Index of the closest centroid for every row of X, in row blocks. """
+    assign = np.empty(X.shape[0], dtype=np.int64)
+    for i in range(0, X.shape[0], block_size):
+        assign[i:i + block_size] = np.argmin(
+            _sq_dists(X[i:i + block_size], centroids), axis=1)
+    return assign
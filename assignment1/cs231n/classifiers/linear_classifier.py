@@ -2,7 +2,9 @@ from __future__ import print_function
 
 from builtins import range
 from builtins import object
+import time
 import numpy as np
+import scipy.optimize
 from cs231n.classifiers.linear_svm import *
 from cs231n.classifiers.softmax import *
 from past.builtins import xrange
@@ -14,7 +16,7 @@ class LinearClassifier(object):
         self.W = None
 
     def train(self, X, y, learning_rate=1e-3, reg=1e-5, num_iters=100,
-              batch_size=200, verbose=False):
+              batch_size=200, verbose=False, sampler='random'):
         """
         Train this linear classifier using stochastic gradient descent.
 
@@ -28,6 +30,11 @@ class LinearClassifier(object):
         - num_iters: (integer) number of steps to take when optimizing
         - batch_size: (integer) number of training examples to use at each step.
         - verbose: (boolean) If true, print progress during optimization.
+        - sampler: (string) How minibatches are drawn. 'random' samples each
+          batch independently with replacement. 'epoch' shuffles the data once
+          per epoch and serves consecutive slices of the permutation, so every
+          example is used exactly once per epoch; the rows are gathered in
+          increasing order into batch arrays allocated once.
 
         Outputs:
         A list containing the value of the loss function at each training iteration.
@@ -38,6 +45,13 @@ class LinearClassifier(object):
             # lazily initialize W
             self.W = 0.001 * np.random.randn(dim, num_classes)
 
+        if sampler == 'epoch':
+            batches = _epoch_batches(num_train, batch_size)
+            X_buffer = np.empty((min(batch_size, num_train), dim), dtype=X.dtype)
+            y_buffer = np.empty(min(batch_size, num_train), dtype=y.dtype)
+        elif sampler != 'random':
+            raise ValueError('Unrecognized sampler "%s"' % sampler)
+
         # Run stochastic gradient descent to optimize W
         loss_history = []
         for it in range(num_iters):
@@ -56,11 +70,20 @@ class LinearClassifier(object):
             # replacement is faster than sampling without replacement.              #
             #########################################################################
             # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
-            ind_batch = np.random.choice(num_train, batch_size, replace=True)
-            
-            # build the batches
-            X_batch = X[ind_batch, :]
-            y_batch = y[ind_batch]
+            if sampler == 'epoch':
+                ind_batch = next(batches)
+                X_batch = X_buffer[:len(ind_batch)]
+                y_batch = y_buffer[:len(ind_batch)]
+                # the indices are always in range; mode='clip' lets np.take
+                # write into out directly instead of through a temporary
+                np.take(X, ind_batch, axis=0, out=X_batch, mode='clip')
+                np.take(y, ind_batch, out=y_batch, mode='clip')
+            else:
+                ind_batch = np.random.choice(num_train, batch_size, replace=True)
+
+                # build the batches
+                X_batch = X[ind_batch, :]
+                y_batch = y[ind_batch]
 #             pass
 
             # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
@@ -85,6 +108,155 @@ class LinearClassifier(object):
 
         return loss_history
 
+    def train_lbfgs(self, X, y, reg=1e-5, num_iters=100, batch_size=None,
+                    chunk_size=None, history_size=10, target_loss=None,
+                    verbose=False):
+        """
+        Train this linear classifier using full-batch L-BFGS.
+
+        Instead of fixed-size SGD steps, L-BFGS builds a low-rank estimate of
+        the curvature from its last history_size steps and picks the step size
+        with a line search, which typically converges in far fewer iterations
+        on precomputed features. The objective is the average of self.loss
+        over the training set, evaluated chunk by chunk so that no (N, C)
+        temporary is ever needed for the whole training set.
+
+        Inputs:
+        - X, y: Training data and labels, as for train.
+        - reg: (float) regularization strength.
+        - num_iters: (integer) maximum number of L-BFGS iterations.
+        - batch_size: (integer) if given, optimize over a fixed random subset of
+          this many training examples instead of all of them.
+        - chunk_size: (integer) number of examples per call to self.loss; all of
+          them at once if None.
+        - history_size: (integer) number of past steps used by L-BFGS.
+        - target_loss: (float) if given, report the time taken to first reach
+          this loss.
+        - verbose: (boolean) If true, print progress during optimization.
+
+        Outputs:
+        A dictionary with keys
+        - loss_history: the loss at each evaluation of the objective
+        - time_history: the wall-clock time in seconds of each evaluation
+        - time_to_target: seconds until the loss first reached target_loss, or
+          None if it never did
+        - num_iters: the number of L-BFGS iterations taken
+        """
+        num_train, dim = X.shape
+        num_classes = np.max(y) + 1
+        if self.W is None:
+            self.W = 0.001 * np.random.randn(dim, num_classes)
+        if batch_size is not None and batch_size < num_train:
+            subset = np.sort(np.random.choice(num_train, batch_size,
+                                              replace=False))
+            X, y = X[subset], y[subset]
+            num_train = batch_size
+        if chunk_size is None:
+            chunk_size = num_train
+
+        loss_history = []
+        time_history = []
+        start_time = time.time()
+
+        def objective(w):
+            self.W = w.reshape(dim, num_classes)
+            loss, grad = 0.0, np.zeros_like(self.W)
+            for start in range(0, num_train, chunk_size):
+                X_chunk = X[start:start + chunk_size]
+                # regularization is added once below, not once per chunk
+                chunk_loss, chunk_grad = self.loss(
+                    X_chunk, y[start:start + chunk_size], 0.0)
+                loss += chunk_loss * X_chunk.shape[0]
+                grad += chunk_grad * X_chunk.shape[0]
+            loss = loss / num_train + reg * np.sum(self.W * self.W)
+            grad = grad / num_train + 2 * reg * self.W
+
+            loss_history.append(loss)
+            time_history.append(time.time() - start_time)
+            if verbose:
+                print('evaluation %d: loss %f' % (len(loss_history), loss))
+            return loss, grad.ravel()
+
+        result = scipy.optimize.minimize(
+            objective, self.W.ravel(), jac=True, method='L-BFGS-B',
+            options={'maxiter': num_iters, 'maxcor': history_size})
+        self.W = result.x.reshape(dim, num_classes)
+
+        time_to_target = None
+        if target_loss is not None:
+            for loss, elapsed in zip(loss_history, time_history):
+                if loss <= target_loss:
+                    time_to_target = elapsed
+                    break
+
+        return {
+          'loss_history': loss_history,
+          'time_history': time_history,
+          'time_to_target': time_to_target,
+          'num_iters': result.nit,
+        }
+
+    @classmethod
+    def train_multiple(cls, X, y, learning_rates, regs, num_iters=100,
+                       batch_size=200, verbose=False, sampler='random'):
+        """
+        Train K classifiers with different hyperparameters in one pass.
+
+        The weight matrices of all models are stacked into a single (D, K * C)
+        matrix, so each step computes the scores of every model with one
+        matrix multiplication on a shared minibatch. Each model keeps its own
+        loss, gradient, regularization and learning rate.
+
+        Inputs:
+        - X, y, num_iters, batch_size, verbose, sampler: As for train.
+        - learning_rates: List of K learning rates; learning_rates[k] is used
+          for model k.
+        - regs: List of K regularization strengths.
+
+        Returns a tuple of:
+        - models: List of K trained classifiers of this class.
+        - loss_histories: List of K lists giving the loss of each model at each
+          training iteration.
+        """
+        if len(learning_rates) != len(regs):
+            raise ValueError('Need as many learning rates as regularizations')
+        num_train, dim = X.shape
+        num_classes = np.max(y) + 1
+        num_models = len(regs)
+        stacked = cls()
+        W = 0.001 * np.random.randn(dim, num_models * num_classes)
+        step_sizes = np.repeat(np.asarray(learning_rates, dtype=float),
+                               num_classes)
+
+        if sampler == 'epoch':
+            batches = _epoch_batches(num_train, batch_size)
+        elif sampler != 'random':
+            raise ValueError('Unrecognized sampler "%s"' % sampler)
+
+        loss_histories = [[] for _ in range(num_models)]
+        for it in range(num_iters):
+            if sampler == 'epoch':
+                ind_batch = next(batches)
+            else:
+                ind_batch = np.random.choice(num_train, batch_size, replace=True)
+
+            losses, grad = stacked.loss_stacked(W, X[ind_batch], y[ind_batch],
+                                                regs)
+            for history, loss in zip(loss_histories, losses):
+                history.append(loss)
+            W -= step_sizes * grad
+
+            if verbose and it % 100 == 0:
+                print('iteration %d / %d: best loss %f'
+                      % (it, num_iters, np.min(losses)))
+
+        models = []
+        for k in range(num_models):
+            model = cls()
+            model.W = W[:, k * num_classes:(k + 1) * num_classes].copy()
+            models.append(model)
+        return models, loss_histories
+
     def predict(self, X):
         """
         Use the trained weights of this linear classifier to predict labels for
@@ -129,6 +301,22 @@ class LinearClassifier(object):
         """
         pass
 
+    def loss_stacked(self, W, X_batch, y_batch, regs):
+        """
+        Compute the losses and derivative of K models stacked along the columns
+        of W, as used by train_multiple. Subclasses will override this.
+
+        Inputs:
+        - W: A numpy array of shape (D, K * C) holding the weights of K models.
+        - X_batch, y_batch: As for loss.
+        - regs: A numpy array of shape (K,) of regularization strengths.
+
+        Returns: A tuple containing:
+        - losses as an array of shape (K,)
+        - gradient with respect to W; an array of the same shape as W
+        """
+        pass
+
 
 class LinearSVM(LinearClassifier):
     """ A subclass that uses the Multiclass SVM loss function """
@@ -136,9 +324,28 @@ class LinearSVM(LinearClassifier):
     def loss(self, X_batch, y_batch, reg):
         return svm_loss_vectorized(self.W, X_batch, y_batch, reg)
 
+    def loss_stacked(self, W, X_batch, y_batch, regs):
+        return svm_loss_stacked(W, X_batch, y_batch, regs)
+
 
 class Softmax(LinearClassifier):
     """ A subclass that uses the Softmax + Cross-entropy loss function """
 
     def loss(self, X_batch, y_batch, reg):
         return softmax_loss_vectorized(self.W, X_batch, y_batch, reg)
+
+    def loss_stacked(self, W, X_batch, y_batch, regs):
+        return softmax_loss_stacked(W, X_batch, y_batch, regs)
+
+
+def _epoch_batches(num_train, batch_size):
+    """
+    Endlessly yield minibatch indices, one epoch at a time: each epoch is a new
+    random permutation of the training set cut into consecutive slices (the
+    last one may be smaller). Each slice is sorted so that gathering its rows
+    walks through memory in order.
+    """
+    while True:
+        permutation = np.random.permutation(num_train)
+        for start in range(0, num_train, batch_size):
+            yield np.sort(permutation[start:start + batch_size])
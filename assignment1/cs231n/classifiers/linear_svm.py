@@ -84,7 +84,7 @@ def svm_loss_vectorized(W, X, y, reg):
     #############################################################################
     # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
     scores = np.dot(X, W) # (num_train, num_classes)
-    margins = 1 - np.expand_dims(np.choose(y, scores.T), axis=1) + scores # (num_train, num_classes)
+    margins = 1 - np.expand_dims(scores[np.arange(num_train), y], axis=1) + scores # (num_train, num_classes)
     margins[np.arange(num_train), y] = 0 
     loss = 1/num_train * np.sum(np.maximum(0, margins)) + reg*np.sum(W**2)
 
@@ -117,3 +117,101 @@ def svm_loss_vectorized(W, X, y, reg):
     # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
 
     return loss, dW
+
+
+def svm_loss_stacked(W, X, y, regs):
+    """
+    Structured SVM loss of K independent models at once.
+
+    The weights of the K models are stacked side by side so that the scores of
+    all of them come from a single matrix multiplication; losses, gradients
+    and regularization are still computed separately per model.
+
+    Inputs:
+    - W: A numpy array of shape (D, K * C); columns k * C to (k + 1) * C hold the
+      weights of model k.
+    - X: A numpy array of shape (N, D) containing a minibatch of data.
+    - y: A numpy array of shape (N,) containing training labels.
+    - regs: A numpy array of shape (K,) giving the regularization strength of
+      each model.
+
+    Returns a tuple of:
+    - losses: A numpy array of shape (K,) giving the loss of each model
+    - gradient with respect to W; an array of same shape as W
+    """
+    num_train = X.shape[0]
+    num_models = len(regs)
+    num_classes = W.shape[1] // num_models
+    regs = np.asarray(regs, dtype=float)
+
+    scores = np.dot(X, W).reshape(num_train, num_models, num_classes)
+    rows = np.arange(num_train)
+    correct_class_scores = scores[rows, :, y] # (num_train, num_models)
+    margins = scores - correct_class_scores[:, :, np.newaxis] + 1
+    margins[rows, :, y] = 0
+    np.maximum(margins, 0, out=margins)
+    losses = margins.sum(axis=(0, 2)) / num_train
+
+    # every positive margin pulls its class up and the correct class down
+    contributes = (margins > 0).astype(W.dtype)
+    contributes[rows, :, y] -= contributes.sum(axis=2)
+    dW = np.dot(X.T, contributes.reshape(num_train, -1)) / num_train
+
+    W_models = W.reshape(W.shape[0], num_models, num_classes)
+    losses += regs * np.sum(W_models**2, axis=(0, 2))
+    dW += 2 * np.repeat(regs, num_classes) * W
+    return losses, dW
+
+
+def svm_loss_fused(W, X, y, reg, dtype=None, chunk_size=None):
+    """
+    Structured SVM loss function, fused single-buffer implementation.
+
+    Computes the same loss and gradient as svm_loss_vectorized, but the scores,
+    margins and gradient coefficients of a chunk of examples all live in one
+    (chunk_size, C) buffer that is updated in place, so memory stays bounded
+    even when C is in the thousands.
+
+    Inputs are the same as svm_loss_naive, plus:
+    - dtype: Optional dtype, e.g. np.float32, for the scores and matrix
+      products; the loss and gradient are accumulated in float64.
+    - chunk_size: Number of examples processed at a time; all of them if None.
+
+    Returns a tuple of:
+    - loss as single float
+    - gradient with respect to weights W; an array of same shape as W
+    """
+    num_train = X.shape[0]
+    if chunk_size is None:
+        chunk_size = num_train
+    if dtype is None:
+        dtype = np.result_type(W.dtype, X.dtype)
+    W_compute = W.astype(dtype, copy=False)
+    buffer = np.empty((min(chunk_size, num_train), W.shape[1]), dtype=dtype)
+
+    loss = 0.0
+    dW = np.zeros(W.shape)
+    for start in range(0, num_train, chunk_size):
+        X_chunk = X[start:start + chunk_size].astype(dtype, copy=False)
+        y_chunk = y[start:start + chunk_size]
+        rows = np.arange(X_chunk.shape[0])
+
+        # margins, in place in the scores buffer
+        margins = buffer[:X_chunk.shape[0]]
+        np.dot(X_chunk, W_compute, out=margins)
+        margins -= margins[rows, y_chunk][:, np.newaxis]
+        margins += 1
+        margins[rows, y_chunk] = 0
+        np.maximum(margins, 0, out=margins)
+        loss += np.sum(margins, dtype=np.float64)
+
+        # turn the margins into gradient coefficients: 1 for every positive
+        # margin and minus their count for the correct class
+        np.sign(margins, out=margins)
+        margins[rows, y_chunk] = -np.sum(margins, axis=1)
+        dW += np.dot(X_chunk.T, margins)
+
+    loss = loss / num_train + reg * np.sum(W * W)
+    dW /= num_train
+    dW += 2 * reg * W
+    return loss, dW.astype(W.dtype, copy=False)
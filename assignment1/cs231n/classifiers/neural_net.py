@@ -42,6 +42,7 @@ class TwoLayerNet(object):
         self.params['b1'] = np.zeros(hidden_size)
         self.params['W2'] = std * np.random.randn(hidden_size, output_size)
         self.params['b2'] = np.zeros(output_size)
+        self._workspaces = {}
 
     def loss(self, X, y=None, reg=0.0):
         """
@@ -142,10 +143,103 @@ class TwoLayerNet(object):
 
         return loss, grads
 
+    def loss_workspace(self, X, y, reg=0.0):
+        """
+        Compute the loss and gradients like loss, but without allocating any
+        large arrays: the hidden activations, scores and gradients are computed
+        in place in buffers that are allocated once and reused by later calls
+        with the same batch size.
+
+        Inputs: Same as loss, except that y is required.
+
+        Returns: Same as loss. The returned gradients are views of the reused
+        buffers, so they are only valid until the next call.
+        """
+        W1 = self.params['W1']
+        W2, b2 = self.params['W2'], self.params['b2']
+        N = X.shape[0]
+        ws = self._workspace(N, np.result_type(X.dtype, W1.dtype))
+        rows = np.arange(N)
+
+        # forward pass, with the ReLU applied in place on the hidden layer
+        A1 = self._hidden(X, ws['A1'])
+        Z2 = ws['scores']
+        np.dot(A1, W2, out=Z2)
+        Z2 += b2
+        # for numerical stability
+        Z2 -= np.max(Z2, axis=1, keepdims=True)
+        correct_Z2 = Z2[rows, y]
+
+        # softmax loss; Z2 becomes the predictions Y_hat in place
+        np.exp(Z2, out=Z2)
+        sum_exp_Z2 = np.sum(Z2, axis=1)
+        loss = np.mean(np.log(sum_exp_Z2) - correct_Z2)
+        loss += reg * (np.vdot(W1, W1) + np.vdot(W2, W2))
+
+        # backward pass; Z2 becomes dZ2 = (Y_hat - y_onehot) / N in place
+        grads = ws['grads']
+        Z2 /= sum_exp_Z2[:, np.newaxis]
+        Z2[rows, y] -= 1
+        Z2 /= N
+        np.dot(A1.T, Z2, out=grads['W2'])
+        np.sum(Z2, axis=0, out=grads['b2'])
+
+        dZ1 = ws['dZ1']
+        np.dot(Z2, W2.T, out=dZ1)
+        np.greater(A1, 0, out=ws['mask'])
+        dZ1 *= ws['mask']
+        np.dot(X.T, dZ1, out=grads['W1'])
+        np.sum(dZ1, axis=0, out=grads['b1'])
+
+        # add the regularization gradient without temporaries
+        for name in ('W1', 'W2'):
+            np.multiply(self.params[name], 2 * reg, out=ws['reg_' + name])
+            grads[name] += ws['reg_' + name]
+
+        return loss, grads
+
+    def _workspace(self, N, dtype):
+        """
+        Return the training buffers for a batch of N examples. Only the buffers
+        for the most recent batch size and dtype are kept.
+        """
+        key = (N, np.dtype(dtype).str)
+        if key not in self._workspaces:
+            D, H = self.params['W1'].shape
+            C = self.params['W2'].shape[1]
+            self._workspaces.clear()
+            self._workspaces[key] = {
+              'A1': np.empty((N, H), dtype=dtype),
+              'mask': np.empty((N, H), dtype=bool),
+              'dZ1': np.empty((N, H), dtype=dtype),
+              'scores': np.empty((N, C), dtype=dtype),
+              'X_batch': None,
+              'y_batch': None,
+              'grads': {name: np.empty(p.shape, dtype=dtype)
+                        for name, p in self.params.items()},
+              'reg_W1': np.empty((D, H), dtype=dtype),
+              'reg_W2': np.empty((H, C), dtype=dtype),
+            }
+        return self._workspaces[key]
+
+    def __getstate__(self):
+        # the workspace buffers are scratch space; don't pickle them
+        state = self.__dict__.copy()
+        state['_workspaces'] = {}
+        return state
+
+    def _hidden(self, X, A1):
+        """ Hidden layer activations ReLU(X W1 + b1), computed in A1. """
+        np.dot(X, self.params['W1'], out=A1)
+        A1 += self.params['b1']
+        np.maximum(A1, 0, out=A1)
+        return A1
+
     def train(self, X, y, X_val, y_val,
               learning_rate=1e-3, learning_rate_decay=0.95,
               reg=5e-6, num_iters=100,
-              batch_size=200, verbose=False):
+              batch_size=200, verbose=False, use_workspace=True,
+              predict_batch_size=1000):
         """
         Train this neural network using stochastic gradient descent.
 
@@ -162,6 +256,11 @@ class TwoLayerNet(object):
         - num_iters: Number of steps to take when optimizing.
         - batch_size: Number of training examples to use per step.
         - verbose: boolean; if true print progress during optimization.
+        - use_workspace: boolean; if true, gather minibatches, compute gradients
+          and update the parameters in place in buffers allocated once, using
+          loss_workspace, instead of allocating new arrays every iteration.
+        - predict_batch_size: Number of examples scored at a time when checking
+          the validation accuracy.
         """
         num_train = X.shape[0]
         iterations_per_epoch = max(num_train / batch_size, 1)
@@ -181,12 +280,29 @@ class TwoLayerNet(object):
             #########################################################################
             # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
             ind_batch = np.random.choice(num_train, batch_size, replace=True)
-            X_batch = X[ind_batch, :]
-            y_batch = y[ind_batch]
+            if use_workspace:
+                # same key as in loss_workspace, so both share one workspace
+                ws = self._workspace(batch_size, np.result_type(
+                    X.dtype, self.params['W1'].dtype))
+                if ws['X_batch'] is None or ws['X_batch'].dtype != X.dtype:
+                    ws['X_batch'] = np.empty((batch_size,) + X.shape[1:], X.dtype)
+                if ws['y_batch'] is None or ws['y_batch'].dtype != y.dtype:
+                    ws['y_batch'] = np.empty(batch_size, dtype=y.dtype)
+                # mode='clip' lets take write straight into out instead of
+                # buffering the result; the indices are always in range
+                X_batch = np.take(X, ind_batch, axis=0, out=ws['X_batch'],
+                                  mode='clip')
+                y_batch = np.take(y, ind_batch, out=ws['y_batch'], mode='clip')
+            else:
+                X_batch = X[ind_batch, :]
+                y_batch = y[ind_batch]
             # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
 
             # Compute loss and gradients using the current minibatch
-            loss, grads = self.loss(X_batch, y=y_batch, reg=reg)
+            if use_workspace:
+                loss, grads = self.loss_workspace(X_batch, y_batch, reg=reg)
+            else:
+                loss, grads = self.loss(X_batch, y=y_batch, reg=reg)
             loss_history.append(loss)
 
             #########################################################################
@@ -198,7 +314,13 @@ class TwoLayerNet(object):
             # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
 
             for param in self.params:
-                self.params[param] -= learning_rate * grads[param]
+                if use_workspace:
+                    # the gradient buffers are overwritten by the next call
+                    # anyway, so scale them in place
+                    grads[param] *= learning_rate
+                    self.params[param] -= grads[param]
+                else:
+                    self.params[param] -= learning_rate * grads[param]
 
             # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
 
@@ -208,8 +330,8 @@ class TwoLayerNet(object):
             # Every epoch, check train and val accuracy and decay learning rate.
             if it % iterations_per_epoch == 0:
                 # Check accuracy
-                train_acc = (self.predict(X_batch) == y_batch).mean()
-                val_acc = (self.predict(X_val) == y_val).mean()
+                train_acc = (self.predict(X_batch, predict_batch_size) == y_batch).mean()
+                val_acc = (self.predict(X_val, predict_batch_size) == y_val).mean()
                 train_acc_history.append(train_acc)
                 val_acc_history.append(val_acc)
 
@@ -222,7 +344,7 @@ class TwoLayerNet(object):
           'val_acc_history': val_acc_history,
         }
 
-    def predict(self, X):
+    def predict(self, X, batch_size=None):
         """
         Use the trained weights of this two-layer network to predict labels for
         data points. For each data point we predict scores for each of the C
@@ -231,6 +353,9 @@ class TwoLayerNet(object):
         Inputs:
         - X: A numpy array of shape (N, D) giving N D-dimensional data points to
           classify.
+        - batch_size: If given, score X in batches of this many examples, with
+          buffers for the hidden activations and scores that are reused across
+          batches.
 
         Returns:
         - y_pred: A numpy array of shape (N,) giving predicted labels for each of
@@ -245,10 +370,25 @@ class TwoLayerNet(object):
         # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
         W1, b1 = self.params['W1'], self.params['b1']
         W2, b2 = self.params['W2'], self.params['b2']
-        Z1 = np.dot(X, W1) + b1
-        A1 = np.maximum(Z1, 0)
-        scores = np.dot(A1, W2) + b2
-        y_pred = np.argmax(scores, axis=1)
+        if batch_size is None:
+            Z1 = np.dot(X, W1) + b1
+            A1 = np.maximum(Z1, 0)
+            scores = np.dot(A1, W2) + b2
+            y_pred = np.argmax(scores, axis=1)
+        else:
+            N = X.shape[0]
+            dtype = np.result_type(X.dtype, W1.dtype)
+            # the last, smaller batch uses the leading rows of the buffers
+            A1_buf = np.empty((min(batch_size, N), W1.shape[1]), dtype=dtype)
+            scores_buf = np.empty((A1_buf.shape[0], W2.shape[1]), dtype=dtype)
+            y_pred = np.empty(N, dtype=np.intp)
+            for start in range(0, N, batch_size):
+                X_chunk = X[start:start + batch_size]
+                n = X_chunk.shape[0]
+                A1 = self._hidden(X_chunk, A1_buf[:n])
+                scores = np.dot(A1, W2, out=scores_buf[:n])
+                scores += b2
+                y_pred[start:start + batch_size] = np.argmax(scores, axis=1)
 
         # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
 
@@ -112,3 +112,85 @@ def softmax_loss_vectorized(W, X, y, reg):
     # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
 
     return loss, dW
+
+
+def softmax_loss_stacked(W, X, y, regs):
+    """
+    Softmax loss of K independent models at once.
+
+    Inputs and outputs are the same as svm_loss_stacked.
+    """
+    N = X.shape[0]
+    K = len(regs)
+    C = W.shape[1] // K
+    regs = np.asarray(regs, dtype=float)
+
+    # logits of every model from one matrix multiplication
+    Z = np.dot(X, W).reshape(N, K, C)
+    # for numerical stability
+    Z -= np.max(Z, axis=2, keepdims=True)
+    rows = np.arange(N)
+
+    exp_Z = np.exp(Z)
+    sum_exp_Z = np.sum(exp_Z, axis=2)
+    losses = np.mean(np.log(sum_exp_Z) - Z[rows, :, y], axis=0)
+
+    # gradient of the loss with respect to the logits: Y_hat - y_onehot
+    dZ = exp_Z
+    dZ /= sum_exp_Z[:, :, np.newaxis]
+    dZ[rows, :, y] -= 1
+    dW = 1/N * np.dot(X.T, dZ.reshape(N, -1))
+
+    # add the regularization term of each model
+    losses += regs * np.sum(W.reshape(W.shape[0], K, C)**2, axis=(0, 2))
+    dW += 2 * np.repeat(regs, C) * W
+    return losses, dW
+
+
+def softmax_loss_fused(W, X, y, reg, dtype=None, chunk_size=None):
+    """
+    Softmax loss function, fused single-buffer implementation.
+
+    Computes the same loss and gradient as softmax_loss_vectorized, but the
+    logits, probabilities and gradient with respect to the logits of a chunk
+    of examples all live in one (chunk_size, C) buffer that is updated in
+    place, so memory stays bounded even when C is in the thousands.
+
+    Inputs and outputs are the same as svm_loss_fused.
+    """
+    N = X.shape[0]
+    if chunk_size is None:
+        chunk_size = N
+    if dtype is None:
+        dtype = np.result_type(W.dtype, X.dtype)
+    W_compute = W.astype(dtype, copy=False)
+    buffer = np.empty((min(chunk_size, N), W.shape[1]), dtype=dtype)
+
+    loss = 0.0
+    dW = np.zeros(W.shape)
+    for start in range(0, N, chunk_size):
+        X_chunk = X[start:start + chunk_size].astype(dtype, copy=False)
+        y_chunk = y[start:start + chunk_size]
+        rows = np.arange(X_chunk.shape[0])
+
+        # compute the logits, shifted for numerical stability
+        Z = buffer[:X_chunk.shape[0]]
+        np.dot(X_chunk, W_compute, out=Z)
+        Z -= np.max(Z, axis=1, keepdims=True)
+        correct_Z = Z[rows, y_chunk].astype(np.float64)
+
+        # turn the logits into the predictions Y_hat in place
+        np.exp(Z, out=Z)
+        sum_exp_Z = np.sum(Z, axis=1, keepdims=True)
+        loss += np.sum(np.log(sum_exp_Z, dtype=np.float64)) - np.sum(correct_Z)
+        Z /= sum_exp_Z
+
+        # and then into the gradient Y_hat - y_onehot
+        Z[rows, y_chunk] -= 1
+        dW += np.dot(X_chunk.T, Z)
+
+    # add the regularization term
+    loss = loss / N + reg * np.sum(W**2)
+    dW /= N
+    dW += 2*reg * W
+    return loss, dW.astype(W.dtype, copy=False)
@@ -1,14 +1,23 @@
 from __future__ import print_function
-from builtins import zip
 from builtins import range
 from past.builtins import xrange
 
+import functools
+import hashlib
+import multiprocessing
+import os
+import sys
+import time
+import types
+import warnings
+
 import matplotlib
 import numpy as np
-from scipy.ndimage import uniform_filter
+from scipy.ndimage import uniform_filter, uniform_filter1d
 
 
-def extract_features(imgs, feature_fns, verbose=False):
+def extract_features(imgs, feature_fns, verbose=False, num_workers=None,
+                     chunk_size=1000, out=None):
     """
     Given pixel data for images and several feature functions that can operate on
     single images, apply all feature functions to all images, concatenating the
@@ -21,6 +30,12 @@ def extract_features(imgs, feature_fns, verbose=False):
       take as input an H x W x D array and return a (one-dimensional) array of
       length F_i.
     - verbose: Boolean; if true, print progress.
+    - num_workers: If given, extract features in a pool of this many processes;
+      see iter_features.
+    - chunk_size: Number of images processed per chunk.
+    - out: Optional output: either an array of shape (N, F_1 + ... + F_k) to
+      fill, or a filename under which a .npy memmap of that shape is created,
+      so that the features never have to fit in memory.
 
     Returns:
     An array of shape (N, F_1 + ... + F_k) where each column is the concatenation
@@ -30,32 +45,297 @@ def extract_features(imgs, feature_fns, verbose=False):
     if num_images == 0:
         return np.array([])
 
-    # Use the first image to determine feature dimensions
+    # Use the first image to determine feature dimensions, so that we can
+    # allocate a single big array to store all features as columns.
+    total_feature_dim = sum(_feature_dims(imgs, feature_fns))
+    if out is None:
+        imgs_features = np.zeros((num_images, total_feature_dim))
+    elif isinstance(out, str):
+        imgs_features = np.lib.format.open_memmap(
+            out, mode='w+', shape=(num_images, total_feature_dim))
+    else:
+        if out.shape != (num_images, total_feature_dim):
+            raise ValueError('out has shape %s but the features have shape %s'
+                             % (out.shape, (num_images, total_feature_dim)))
+        imgs_features = out
+
+    start_time = time.time()
+    for start, features in iter_features(imgs, feature_fns, chunk_size,
+                                         num_workers):
+        imgs_features[start:start + features.shape[0]] = features
+        if verbose:
+            done = start + features.shape[0]
+            rate = done / max(time.time() - start_time, 1e-12)
+            print('Done extracting features for %d / %d images '
+                  '(%.0f images/s, ETA %.0fs)'
+                  % (done, num_images, rate, (num_images - done) / rate))
+
+    return imgs_features
+
+
+def cached_extract_features(imgs, feature_fns, cache_dir=None,
+                            max_cache_bytes=2**32, **kwargs):
+    """
+    Cached version of extract_features.
+
+    Results are stored as .npy files under cache_dir, named by a hash of the
+    image array (its shape, dtype and contents) and of each feature function:
+    its code, default and bound arguments (e.g. nbin, xmin, xmax for a
+    functools.partial of color_histogram_hsv), closure and the global values
+    and functions it refers to; arrays among these are hashed by content.
+    Computing the same features of the same images again is therefore just a
+    file read. If a feature function depends on a value that cannot be
+    fingerprinted reliably, a warning is issued and nothing is cached. When the cache grows beyond
+    max_cache_bytes the least recently used files are removed.
+
+    Inputs:
+    - imgs, feature_fns: See extract_features.
+    - cache_dir: Directory holding the cached features; defaults to
+      ~/.cache/cs231n/features, outside the repository.
+    - max_cache_bytes: Size limit of the cache directory.
+    - kwargs: Other arguments passed to extract_features on a cache miss.
+
+    Returns:
+    An array of shape (N, F_1 + ... + F_k) as returned by extract_features.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'cs231n',
+                                 'features')
+    key = hashlib.sha1()
+    key.update(repr((imgs.shape, imgs.dtype.str)).encode('utf-8'))
+    for start in range(0, imgs.shape[0], 1000):
+        key.update(np.ascontiguousarray(imgs[start:start + 1000]).data)
+    try:
+        for feature_fn in feature_fns:
+            key.update(_fingerprint(feature_fn).encode('utf-8'))
+    except _UncacheableError as e:
+        warnings.warn('features are not cached: %s' % e)
+        return extract_features(imgs, feature_fns, **kwargs)
+    path = os.path.join(cache_dir, key.hexdigest() + '.npy')
+
+    if os.path.exists(path):
+        os.utime(path, None) # mark as recently used
+        return np.load(path)
+
+    imgs_features = extract_features(imgs, feature_fns, **kwargs)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # write under a temporary name first so readers never see a partial file
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, imgs_features)
+    os.rename(tmp_path, path)
+    _evict_lru(cache_dir, max_cache_bytes)
+    return imgs_features
+
+
+def _fingerprint(fn, seen=None):
+    """
+    A string identifying what a feature function computes, stable across
+    runs, for keying cached_extract_features. Raises _UncacheableError if the
+    function depends on a value that cannot be fingerprinted reliably.
+    """
+    if seen is None:
+        seen = set()
+    if isinstance(fn, functools.partial):
+        return 'partial(%s, %s, %s)' % (_fingerprint(fn.func, seen),
+                                        _value_fingerprint(fn.args, seen),
+                                        _value_fingerprint(fn.keywords, seen))
+    code = getattr(fn, '__code__', None)
+    if code is None:
+        # builtin and compiled functions such as np.dot: identify them by the
+        # name they are importable under
+        name = _import_name(fn)
+        if name is not None:
+            return name
+        # any other callable object: identify it by its type and attributes
+        return '%s.%s(%s)' % (type(fn).__module__, type(fn).__name__,
+                              _value_fingerprint(getattr(fn, '__dict__', {}),
+                                                 seen))
+    if code in seen:
+        return fn.__name__
+    seen.add(code)
+
+    parts = [fn.__module__, fn.__name__, _code_fingerprint(code),
+             _value_fingerprint(fn.__defaults__, seen),
+             _value_fingerprint(getattr(fn, '__kwdefaults__', None), seen)]
+    for cell in fn.__closure__ or ():
+        try:
+            parts.append(_value_fingerprint(cell.cell_contents, seen))
+        except ValueError: # an empty cell
+            parts.append('<empty>')
+    # include the globals the function uses, e.g. a num_bins variable of a
+    # notebook, an array of weights or the helper functions it calls
+    for name in sorted(_code_names(code)):
+        if name in fn.__globals__:
+            parts.append('%s=%s' % (name, _value_fingerprint(
+                fn.__globals__[name], seen)))
+    return repr(parts)
+
+
+def _import_name(fn):
+    """ 'module.name' if fn is importable under that name, otherwise None. """
+    module = sys.modules.get(getattr(fn, '__module__', None))
+    name = getattr(fn, '__qualname__', getattr(fn, '__name__', None))
+    if module is None or not isinstance(name, str):
+        return None
+    obj = module
+    for attr in name.split('.'):
+        obj = getattr(obj, attr, None)
+    return '%s.%s' % (module.__name__, name) if obj is fn else None
+
+
+class _UncacheableError(ValueError):
+    """ A feature function depends on a value that cannot be fingerprinted. """
+
+
+def _value_fingerprint(value, seen):
+    """
+    A string identifying a value used by a feature function. Arrays are
+    identified by their dtype, shape and a hash of their contents (repr
+    elides the middle of large arrays), containers recursively.
+    """
+    if value is None or isinstance(value, (bool, int, float, complex, str,
+                                           bytes, np.generic)):
+        return repr(value)
+    if isinstance(value, np.ndarray):
+        if value.dtype.hasobject:
+            raise _UncacheableError('object arrays cannot be fingerprinted')
+        digest = hashlib.sha1(np.ascontiguousarray(value).view(np.uint8)).hexdigest()
+        return 'ndarray(%s, %r, %s)' % (value.dtype.str, value.shape, digest)
+    if isinstance(value, (list, tuple)):
+        return '%s(%s)' % (type(value).__name__, ', '.join(
+            _value_fingerprint(v, seen) for v in value))
+    if isinstance(value, (set, frozenset)):
+        return '%s(%s)' % (type(value).__name__, ', '.join(
+            sorted(_value_fingerprint(v, seen) for v in value)))
+    if isinstance(value, dict):
+        return 'dict(%s)' % ', '.join(sorted(
+            '%s: %s' % (_value_fingerprint(k, seen), _value_fingerprint(v, seen))
+            for k, v in value.items()))
+    if isinstance(value, types.ModuleType):
+        return 'module(%s)' % value.__name__
+    if isinstance(value, type):
+        return 'type(%s.%s)' % (value.__module__, value.__qualname__)
+    if isinstance(value, np.ufunc):
+        return 'ufunc(%s)' % value.__name__
+    if callable(value):
+        return _fingerprint(value, seen)
+    raise _UncacheableError('cannot fingerprint a value of type %s'
+                            % type(value).__name__)
+
+
+def _code_fingerprint(code):
+    """
+    The bytecode and constants of a code object. Nested code objects, e.g. of
+    list comprehensions, are fingerprinted recursively rather than with repr,
+    which contains their memory address and so changes in every process.
+    """
+    consts = [_code_fingerprint(const) if isinstance(const, types.CodeType)
+              else repr(const) for const in code.co_consts]
+    return repr((code.co_code, consts))
+
+
+def _code_names(code):
+    """ The global names used by a code object and the code nested in it. """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _code_names(const)
+    return names
+
+
+def _evict_lru(cache_dir, max_cache_bytes):
+    """ Remove least recently used .npy files until the cache fits. """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npy'):
+            stat = os.stat(os.path.join(cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total_bytes <= max_cache_bytes:
+            break
+        os.remove(os.path.join(cache_dir, name))
+        total_bytes -= size
+
+
+def iter_features(imgs, feature_fns, chunk_size=1000, num_workers=None):
+    """
+    Extract features chunk by chunk, yielding each chunk as soon as it is done
+    instead of building the full feature matrix.
+
+    If num_workers is given the chunks are computed by a pool of worker
+    processes and yielded in order. The workers are forked with the images and
+    feature functions already in memory, so lambdas work as feature functions
+    and only the (much smaller) features are sent back.
+
+    Inputs:
+    - imgs, feature_fns: See extract_features.
+    - chunk_size: Number of images per chunk.
+    - num_workers: Number of worker processes; if None, run in this process.
+
+    Yields tuples of:
+    - start: Index of the first image of the chunk.
+    - features: Array of shape (chunk size, F_1 + ... + F_k).
+    """
+    num_images = imgs.shape[0]
+    ranges = [(start, min(start + chunk_size, num_images))
+              for start in range(0, num_images, chunk_size)]
+
+    if num_workers is None:
+        for start, stop in ranges:
+            yield start, _extract_range(start, stop, imgs, feature_fns)
+        return
+
+    # fork explicitly: under spawn (the default on macOS and Windows) the
+    # images would be pickled to every worker and lambdas would fail to pickle
+    pool = multiprocessing.get_context('fork').Pool(
+        num_workers, initializer=_init_worker, initargs=(imgs, feature_fns))
+    try:
+        for start, features in pool.imap(_extract_worker_range, ranges):
+            yield start, features
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _feature_dims(imgs, feature_fns):
+    """ Length of the feature vector of each feature function. """
     feature_dims = []
-    first_image_features = []
     for feature_fn in feature_fns:
         feats = feature_fn(imgs[0].squeeze())
         assert len(feats.shape) == 1, 'Feature functions must be one-dimensional'
         feature_dims.append(feats.size)
-        first_image_features.append(feats)
-
-    # Now that we know the dimensions of the features, we can allocate a single
-    # big array to store all features as columns.
-    total_feature_dim = sum(feature_dims)
-    imgs_features = np.zeros((num_images, total_feature_dim))
-    imgs_features[0] = np.hstack(first_image_features).T
-
-    # Extract features for the rest of the images.
-    for i in range(1, num_images):
-        idx = 0
-        for feature_fn, feature_dim in zip(feature_fns, feature_dims):
-            next_idx = idx + feature_dim
-            imgs_features[i, idx:next_idx] = feature_fn(imgs[i].squeeze())
-            idx = next_idx
-        if verbose and i % 1000 == 999:
-            print('Done extracting features for %d / %d images' % (i+1, num_images))
+    return feature_dims
 
-    return imgs_features
+
+def _extract_range(start, stop, imgs, feature_fns):
+    """ Features of the images start to stop, as a (stop - start, F) array. """
+    first_image_features = np.hstack([feature_fn(imgs[start].squeeze())
+                                      for feature_fn in feature_fns])
+    features = np.zeros((stop - start, first_image_features.size))
+    features[0] = first_image_features
+    for i in range(start + 1, stop):
+        features[i - start] = np.hstack([feature_fn(imgs[i].squeeze())
+                                         for feature_fn in feature_fns])
+    return features
+
+
+# The images and feature functions of an iter_features worker process.
+_worker_imgs = None
+_worker_feature_fns = None
+
+
+def _init_worker(imgs, feature_fns):
+    global _worker_imgs, _worker_feature_fns
+    _worker_imgs = imgs
+    _worker_feature_fns = feature_fns
+
+
+def _extract_worker_range(start_stop):
+    start, stop = start_stop
+    return start, _extract_range(start, stop, _worker_imgs, _worker_feature_fns)
 
 
 def rgb2gray(rgb):
@@ -125,6 +405,69 @@ def hog_feature(im):
     return orientation_histogram.ravel()
 
 
+def hog_feature_batch(ims, chunk_size=1000):
+    """Compute Histogram of Gradient (HOG) features for a stack of images
+
+       Batched version of hog_feature: gradients, orientation binning and
+       cell pooling are computed for many images at once with whole-array
+       operations instead of one image and one orientation at a time. The
+       output is bit-for-bit identical to calling hog_feature on each image.
+
+      Parameters:
+        ims : N x H x W x C array of rgb images or N x H x W array of
+              grayscale images
+        chunk_size : number of images processed together; bounds the size
+              of the intermediate N x H x W x orientations array
+
+      Returns:
+        feats: N x F array where feats[i] is the HOG feature of ims[i]
+
+    """
+    ims = np.asarray(ims)
+    num_images = ims.shape[0]
+    orientations = 9 # number of gradient bins
+    cx, cy = (8, 8) # pixels per cell
+    sx, sy = ims.shape[1:3] # image size
+    n_cellsx = int(np.floor(sx / cx))  # number of cells in x
+    n_cellsy = int(np.floor(sy / cy))  # number of cells in y
+
+    feats = np.zeros((num_images, n_cellsx * n_cellsy * orientations))
+    # orientation bin edges, computed exactly as in hog_feature
+    bin_edges = 180 / orientations * np.arange(orientations + 1)
+
+    for start in range(0, num_images, chunk_size):
+        chunk = ims[start:start + chunk_size]
+        if chunk.ndim == 4:
+            image = rgb2gray(chunk)
+        else:
+            image = chunk.astype(np.float64)
+
+        gx = np.zeros(image.shape)
+        gy = np.zeros(image.shape)
+        gx[:, :, :-1] = np.diff(image, n=1, axis=2) # gradient on x-direction
+        gy[:, :-1, :] = np.diff(image, n=1, axis=1) # gradient on y-direction
+        grad_mag = np.sqrt(gx ** 2 + gy ** 2) # gradient magnitude
+        grad_ori = np.arctan2(gy, (gx + 1e-15)) * (180 / np.pi) + 90 # orientation
+
+        # bin index of every pixel; pixels hog_feature leaves out of every bin
+        # (orientation <= 0 or >= 180) get the out-of-range bin `orientations`
+        bins = np.searchsorted(bin_edges, grad_ori, side='right') - 1
+        bins[(grad_ori <= 0) | (bins < 0)] = orientations
+
+        # magnitudes split into one channel per orientation bin
+        temp_mag = np.where(bins[..., np.newaxis] == np.arange(orientations),
+                            grad_mag[..., np.newaxis], 0)
+        # average over cells with the same separable filter as hog_feature so
+        # the result stays bit-compatible; rows are subsampled between the two
+        # 1-D passes, since the second pass never mixes rows
+        pooled = uniform_filter1d(temp_mag, cx, axis=1)[:, round(cx/2)::cx]
+        pooled = uniform_filter1d(pooled, cy, axis=2)[:, :, round(cy/2)::cy]
+        feats[start:start + chunk_size] = \
+            pooled.transpose(0, 2, 1, 3).reshape(chunk.shape[0], -1)
+
+    return feats
+
+
 def color_histogram_hsv(im, nbin=10, xmin=0, xmax=255, normalized=True):
     """
     Compute color histogram for an image using hue.
@@ -148,3 +491,116 @@ def color_histogram_hsv(im, nbin=10, xmin=0, xmax=255, normalized=True):
 
     # return histogram
     return imhist
+
+
+def color_histogram_hsv_batch(ims, nbin=10, xmin=0, xmax=255, normalized=True,
+                              chunk_size=1000):
+    """
+    Compute color histograms for a stack of images using hue.
+
+    Batched version of color_histogram_hsv with bit-for-bit identical output.
+    Only the hue channel is computed, in one vectorized pass per chunk of
+    images; for uint8 images it is looked up in a precomputed table mapping
+    each of the 256^3 colors to its histogram bin. All histograms of a chunk
+    are then counted at once with a single offset bincount.
+
+    Inputs:
+    - ims: N x H x W x C array of pixel data for N RGB images.
+    - nbin, xmin, xmax, normalized: See color_histogram_hsv.
+    - chunk_size: Number of images processed together.
+
+    Returns:
+      Array of shape (N, nbin) whose ith row is the color histogram of ims[i].
+    """
+    ims = np.asarray(ims)
+    num_images = ims.shape[0]
+    bins = np.linspace(xmin, xmax, nbin+1)
+    bin_widths = np.diff(bins)
+    counts = np.zeros((num_images, nbin), dtype=np.int64)
+
+    lookup = None
+    if ims.dtype == np.uint8:
+        lookup = _hue_bin_table(nbin, xmin, xmax)
+
+    for start in range(0, num_images, chunk_size):
+        chunk = ims[start:start + chunk_size, :, :, :3]
+        num_chunk = chunk.shape[0]
+        if lookup is not None:
+            colors = (chunk[..., 0].astype(np.int32) << 16 |
+                      chunk[..., 1].astype(np.int32) << 8 | chunk[..., 2])
+            hue_bins = lookup[colors].reshape(num_chunk, -1)
+        else:
+            hue_bins = _hue_bins(_hue(chunk / xmax) * xmax, bins)
+            hue_bins = hue_bins.reshape(num_chunk, -1)
+        # offset the bins of image i by i * nbin so that a single bincount
+        # computes every histogram of the chunk; nbin marks pixels outside
+        # [xmin, xmax] and they are dropped
+        valid = hue_bins < nbin
+        offsets = nbin * np.arange(num_chunk)[:, np.newaxis]
+        counts[start:start + num_chunk] = np.bincount(
+            (hue_bins + offsets)[valid], minlength=num_chunk * nbin
+        ).reshape(num_chunk, nbin)
+
+    # same arithmetic as np.histogram(..., density=normalized) * bin widths
+    if normalized:
+        imhist = counts / bin_widths / counts.sum(axis=1, keepdims=True)
+    else:
+        imhist = counts
+    return imhist * bin_widths
+
+
+# Lookup tables of color_histogram_hsv_batch, keyed by (nbin, xmin, xmax).
+_hue_bin_tables = {}
+
+
+def _hue_bin_table(nbin, xmin, xmax):
+    """
+    Table mapping every uint8 color (r << 16 | g << 8 | b) to the hue
+    histogram bin it falls in, or to nbin if it falls outside all bins.
+    """
+    key = (nbin, xmin, xmax)
+    if key not in _hue_bin_tables:
+        bins = np.linspace(xmin, xmax, nbin+1)
+        levels = np.arange(256)
+        table = np.empty(256 ** 3, dtype=np.int16)
+        green_blue = np.stack(np.meshgrid(levels, levels, indexing='ij'), -1)
+        green_blue = green_blue.reshape(-1, 2)
+        for red in range(256):
+            colors = np.empty((256 * 256, 3))
+            colors[:, 0] = red
+            colors[:, 1:] = green_blue
+            table[red * 65536:(red + 1) * 65536] = \
+                _hue_bins(_hue(colors / xmax) * xmax, bins)
+        _hue_bin_tables[key] = table
+    return _hue_bin_tables[key]
+
+
+def _hue(rgb):
+    """
+    Hue channel of matplotlib.colors.rgb_to_hsv, computed with the same
+    operations so the values agree exactly, without the other two channels.
+    """
+    red, green, blue = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    arr_max = rgb.max(-1)
+    delta = arr_max - rgb.min(-1)
+    ipos = delta > 0
+    delta = np.where(ipos, delta, 1)
+    hue = np.zeros(arr_max.shape)
+    # later assignments win, as in rgb_to_hsv
+    hue = np.where((red == arr_max) & ipos, (green - blue) / delta, hue)
+    hue = np.where((green == arr_max) & ipos, 2. + (blue - red) / delta, hue)
+    hue = np.where((blue == arr_max) & ipos, 4. + (red - green) / delta, hue)
+    return (hue / 6.0) % 1.0
+
+
+def _hue_bins(hue, bins):
+    """
+    Histogram bin of every hue value with the same edge rules as np.histogram:
+    bins are half-open except the last one, which includes its right edge.
+    Values outside all bins get bin len(bins) - 1.
+    """
+    nbin = len(bins) - 1
+    hue_bins = np.searchsorted(bins, hue, side='right') - 1
+    hue_bins[hue == bins[-1]] = nbin - 1
+    hue_bins[hue_bins < 0] = nbin
+    return hue_bins
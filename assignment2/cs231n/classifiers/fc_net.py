@@ -291,7 +291,7 @@ class FullyConnectedNet(object):
                 A, cache = affine_bn_relu_forward(A, self.params['W' + str(i)], self.params['b' + str(i)], self.params['gamma' + str(i)], self.params['beta' + str(i)], self.bn_params[i-1], self.normalization)  
                 
             else:
-                A, cache = affine_relu_forward(A, self.params['W' + str(i)], self.params['b' + str(i)]) 
+                A, cache = affine_relu_fused_forward(A, self.params['W' + str(i)], self.params['b' + str(i)])
             
             # use dropout
             if self.use_dropout:
@@ -365,7 +365,7 @@ class FullyConnectedNet(object):
                     grads['beta' + str(i)] = dbeta
                 else:   
                     # compute the gradients
-                    dA, dW, db = affine_relu_backward(dA, cache) 
+                    dA, dW, db = affine_relu_fused_backward(dA, cache)
             
                 # store the gradients (with regularization)
                 grads['W' + str(i)] = dW + self.reg*self.params['W' + str(i)]
@@ -1,4 +1,9 @@
 from __future__ import print_function
+from builtins import object
+from collections import OrderedDict
+import json
+import os
+import time
 import numpy as np
 import torch
 import torch.nn as nn
@@ -13,6 +18,97 @@ except ImportError:
 from cs231n.im2col import *
 
 
+class BufferPool(object):
+    """
+    A pool of reusable workspace arrays for the convolution layers.
+
+    The padded inputs, column matrices and gradient column matrices of a conv
+    layer have the same sizes at every training step, so instead of being
+    allocated on every call they are taken from this pool and handed back
+    when they are no longer needed. Buffers are keyed by their number of
+    elements and dtype and handed out reshaped to the requested shape.
+
+    At most max_bytes are held by the pool; when a buffer is handed back and
+    the pool is over the limit, the buffers of the least recently used sizes
+    are dropped. Setting max_bytes to 0 disables pooling.
+    """
+
+    def __init__(self, max_bytes=2**30):
+        self.max_bytes = max_bytes
+        self.pooled_bytes = 0
+        self._free = OrderedDict()
+
+    def get(self, shape, dtype):
+        """
+        Return an uninitialized C-contiguous array of the given shape and dtype,
+        reusing a pooled buffer of the same size when there is one.
+        """
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        buffers = self._free.get((size, dtype))
+        if buffers:
+            buf = buffers.pop()
+            self.pooled_bytes -= buf.nbytes
+        else:
+            buf = np.empty(size, dtype=dtype)
+        return buf.reshape(shape)
+
+    def release(self, arr):
+        """
+        Hand an array obtained from get, or any view of it, back to the pool.
+        The caller must not use the array afterwards.
+        """
+        buf = arr if arr.base is None else arr.base
+        if not isinstance(buf, np.ndarray) or buf.nbytes > self.max_bytes:
+            return
+        key = (buf.size, buf.dtype)
+        buffers = self._free.setdefault(key, [])
+        if any(b is buf for b in buffers):
+            return
+        buffers.append(buf)
+        self._free.move_to_end(key)
+        self.pooled_bytes += buf.nbytes
+        while self.pooled_bytes > self.max_bytes:
+            old_key, old_buffers = next(iter(self._free.items()))
+            self.pooled_bytes -= old_buffers.pop().nbytes
+            if not old_buffers:
+                del self._free[old_key]
+
+    def clear(self):
+        """ Drop every pooled buffer. """
+        self._free.clear()
+        self.pooled_bytes = 0
+
+
+# The pool shared by the conv layers below. The column matrix of a forward
+# pass is kept in its cache and handed back to the pool by the backward pass,
+# so a cache must not be used for a second backward pass.
+buffer_pool = BufferPool()
+
+
+def _pad_input(x, pad):
+    """
+    Zero-pad x of shape (N, C, H, W) into a pooled buffer; with pad=0 a
+    C-contiguous x is returned as is. Release the result with
+    _release_padded.
+    """
+    if pad == 0:
+        return np.ascontiguousarray(x)
+    N, C, H, W = x.shape
+    x_padded = buffer_pool.get((N, C, H + 2 * pad, W + 2 * pad), x.dtype)
+    x_padded[:, :, :pad] = 0
+    x_padded[:, :, -pad:] = 0
+    x_padded[:, :, pad:-pad, :pad] = 0
+    x_padded[:, :, pad:-pad, -pad:] = 0
+    x_padded[:, :, pad:-pad, pad:-pad] = x
+    return x_padded
+
+
+def _release_padded(x_padded, x):
+    if x_padded is not x:
+        buffer_pool.release(x_padded)
+
+
 def conv_forward_im2col(x, w, b, conv_param):
     """
     A fast implementation of the forward pass for a convolutional layer
@@ -29,14 +125,25 @@ def conv_forward_im2col(x, w, b, conv_param):
     # Create output
     out_height = (H + 2 * pad - filter_height) // stride + 1
     out_width = (W + 2 * pad - filter_width) // stride + 1
-    out = np.zeros((N, num_filters, out_height, out_width), dtype=x.dtype)
 
     # x_cols = im2col_indices(x, w.shape[2], w.shape[3], pad, stride)
-    x_cols = im2col_cython(x, w.shape[2], w.shape[3], pad, stride)
-    res = w.reshape((w.shape[0], -1)).dot(x_cols) + b.reshape(-1, 1)
-
-    out = res.reshape(w.shape[0], out.shape[2], out.shape[3], x.shape[0])
-    out = out.transpose(3, 0, 1, 2)
+    x_padded = _pad_input(x, pad)
+    x_cols = buffer_pool.get((C * filter_height * filter_width,
+                              N * out_height * out_width), x.dtype)
+    im2col_cython(x_padded, filter_height, filter_width, 0, stride, x_cols)
+    _release_padded(x_padded, x)
+
+    w_cols = w.reshape((num_filters, -1))
+    res = buffer_pool.get((num_filters, x_cols.shape[1]),
+                          np.result_type(w_cols, x_cols))
+    np.dot(w_cols, x_cols, out=res)
+    res += b.reshape(-1, 1)
+
+    # copy out of the pooled buffer before handing it back; for N == 1 the
+    # transpose is already contiguous and ascontiguousarray would not copy
+    out = res.reshape(num_filters, out_height, out_width, N)
+    out = out.transpose(3, 0, 1, 2).copy()
+    buffer_pool.release(res)
 
     cache = (x, w, b, conv_param, x_cols)
     return out, cache
@@ -72,8 +179,7 @@ def conv_forward_strides(x, w, b, conv_param):
     #assert (H + 2 * pad - HH) % stride == 0, 'height does not work'
 
     # Pad the input
-    p = pad
-    x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
+    x_padded = _pad_input(x, pad)
 
     # Figure out output dimensions
     H += 2 * pad
@@ -87,20 +193,27 @@ def conv_forward_strides(x, w, b, conv_param):
     strides = x.itemsize * np.array(strides)
     x_stride = np.lib.stride_tricks.as_strided(x_padded,
                   shape=shape, strides=strides)
-    x_cols = np.ascontiguousarray(x_stride)
-    x_cols.shape = (C * HH * WW, N * out_h * out_w)
+    x_cols = buffer_pool.get(shape, x.dtype)
+    x_cols[...] = x_stride
+    x_cols = x_cols.reshape(C * HH * WW, N * out_h * out_w)
+    _release_padded(x_padded, x)
 
     # Now all our convolutions are a big matrix multiply
-    res = w.reshape(F, -1).dot(x_cols) + b.reshape(-1, 1)
+    w_cols = w.reshape(F, -1)
+    res = buffer_pool.get((F, x_cols.shape[1]), np.result_type(w_cols, x_cols))
+    np.dot(w_cols, x_cols, out=res)
+    res += b.reshape(-1, 1)
 
     # Reshape the output
-    res.shape = (F, N, out_h, out_w)
-    out = res.transpose(1, 0, 2, 3)
+    out = res.reshape(F, N, out_h, out_w).transpose(1, 0, 2, 3)
 
     # Be nice and return a contiguous array
     # The old version of conv_forward_fast doesn't do this, so for a fair
     # comparison we won't either
-    out = np.ascontiguousarray(out)
+    # Always copy: for N == 1 or F == 1 the transpose is already contiguous,
+    # and the output must not share memory with the pooled buffer
+    out = out.copy()
+    buffer_pool.release(res)
 
     cache = (x, w, b, conv_param, x_cols)
     return out, cache
@@ -116,12 +229,20 @@ def conv_backward_strides(dout, cache):
 
     db = np.sum(dout, axis=(0, 2, 3))
 
-    dout_reshaped = dout.transpose(1, 0, 2, 3).reshape(F, -1)
+    dout_reshaped = buffer_pool.get((F, N, out_h, out_w), dout.dtype)
+    dout_reshaped[...] = dout.transpose(1, 0, 2, 3)
+    dout_reshaped = dout_reshaped.reshape(F, -1)
     dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
+    buffer_pool.release(x_cols)
 
-    dx_cols = w.reshape(F, -1).T.dot(dout_reshaped)
-    dx_cols.shape = (C, HH, WW, N, out_h, out_w)
-    dx = col2im_6d_cython(dx_cols, N, C, H, W, HH, WW, pad, stride)
+    w_cols = w.reshape(F, -1)
+    dx_cols = buffer_pool.get((C * HH * WW, dout_reshaped.shape[1]),
+                              np.result_type(w_cols, dout_reshaped))
+    np.dot(w_cols.T, dout_reshaped, out=dx_cols)
+    buffer_pool.release(dout_reshaped)
+    dx = col2im_6d_cython(dx_cols.reshape(C, HH, WW, N, out_h, out_w),
+                          N, C, H, W, HH, WW, pad, stride)
+    buffer_pool.release(dx_cols)
 
     return dx, dw, db
 
@@ -137,19 +258,167 @@ def conv_backward_im2col(dout, cache):
     db = np.sum(dout, axis=(0, 2, 3))
 
     num_filters, _, filter_height, filter_width = w.shape
-    dout_reshaped = dout.transpose(1, 2, 3, 0).reshape(num_filters, -1)
+    N, _, out_height, out_width = dout.shape
+    dout_reshaped = buffer_pool.get((num_filters, out_height, out_width, N),
+                                    dout.dtype)
+    dout_reshaped[...] = dout.transpose(1, 2, 3, 0)
+    dout_reshaped = dout_reshaped.reshape(num_filters, -1)
     dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
 
-    dx_cols = w.reshape(num_filters, -1).T.dot(dout_reshaped)
+    w_cols = w.reshape(num_filters, -1)
+    dx_cols = buffer_pool.get(x_cols.shape,
+                              np.result_type(w_cols, dout_reshaped))
+    buffer_pool.release(x_cols)
+    np.dot(w_cols.T, dout_reshaped, out=dx_cols)
+    buffer_pool.release(dout_reshaped)
     # dx = col2im_indices(dx_cols, x.shape, filter_height, filter_width, pad, stride)
     dx = col2im_cython(dx_cols, x.shape[0], x.shape[1], x.shape[2], x.shape[3],
                        filter_height, filter_width, pad, stride)
+    buffer_pool.release(dx_cols)
 
     return dx, dw, db
 
 
-conv_forward_fast = conv_forward_strides
-conv_backward_fast = conv_backward_strides
+def _conv_forward_pytorch_numpy(x, w, b, conv_param):
+    out, cache = conv_forward_pytorch(x, w, b, conv_param)
+    return out.detach().numpy(), cache
+
+
+# The convolution algorithms conv_forward_fast can dispatch to, as
+# (forward, backward) pairs. On ties the first one wins.
+CONV_ALGORITHMS = OrderedDict([
+    ('strides', (conv_forward_strides, conv_backward_strides)),
+    ('im2col', (conv_forward_im2col, conv_backward_im2col)),
+    ('pytorch', (_conv_forward_pytorch_numpy, conv_backward_pytorch)),
+])
+
+
+class ConvAutotuner(object):
+    """
+    Picks the fastest convolution algorithm for each layer geometry.
+
+    The first time a geometry (N, C, H, W, F, HH, WW, stride, pad, dtype) is
+    seen, every algorithm of CONV_ALGORITHMS is timed on a forward and a
+    backward pass with the actual inputs; algorithms that fail, for example
+    because the Cython extension is not built or the geometry is not
+    supported, are skipped. The winner is remembered in memory and in a JSON
+    file at cache_path, so later runs skip the benchmark.
+
+    Setting the environment variable CS231N_CONV_ALGO to one of the names in
+    CONV_ALGORITHMS forces that algorithm and disables the benchmark.
+    """
+
+    def __init__(self, cache_path=None, num_repeats=3):
+        """
+        Inputs:
+        - cache_path: Path of the JSON file of benchmark results, or None to
+          keep them in memory only.
+        - num_repeats: Each algorithm is timed as the best of this many runs,
+          after one warm-up run.
+        """
+        self.cache_path = cache_path
+        self.num_repeats = num_repeats
+        self.choices = None
+
+    def choose(self, x, w, b, conv_param):
+        """ Return the name of the algorithm to use for this layer. """
+        forced = os.environ.get('CS231N_CONV_ALGO')
+        if forced:
+            if forced not in CONV_ALGORITHMS:
+                raise ValueError('Unrecognized conv algorithm "%s"' % forced)
+            return forced
+
+        if self.choices is None:
+            self.choices = self._load()
+        key = ','.join(str(v) for v in x.shape + w.shape[:1] + w.shape[2:] +
+                       (conv_param['stride'], conv_param['pad'], x.dtype))
+        algo = self.choices.get(key)
+        if algo not in CONV_ALGORITHMS:
+            algo = self._benchmark(x, w, b, conv_param)
+            self.choices[key] = algo
+            self._save(key, algo)
+        return algo
+
+    def _benchmark(self, x, w, b, conv_param):
+        best_algo, best_time = None, np.inf
+        for algo, (forward, backward) in CONV_ALGORITHMS.items():
+            try:
+                out, cache = forward(x, w, b, conv_param)
+                dout = np.ones(out.shape, dtype=out.dtype)
+                backward(dout, cache)
+                for _ in range(self.num_repeats):
+                    start = time.time()
+                    out, cache = forward(x, w, b, conv_param)
+                    backward(dout, cache)
+                    elapsed = time.time() - start
+                    if elapsed < best_time:
+                        best_algo, best_time = algo, elapsed
+            except Exception:
+                # the algorithm is not available for this layer
+                continue
+        if best_algo is None:
+            raise RuntimeError('No convolution algorithm ran for input of '
+                               'shape %s and filters of shape %s'
+                               % (x.shape, w.shape))
+        return best_algo
+
+    def _load(self):
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save(self, key, algo):
+        if self.cache_path is None:
+            return
+        # merge with results written by other processes in the meantime
+        choices = self._load()
+        choices[key] = algo
+        cache_dir = os.path.dirname(self.cache_path)
+        tmp_path = '%s.%d.tmp' % (self.cache_path, os.getpid())
+        try:
+            if cache_dir and not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(tmp_path, 'w') as f:
+                json.dump(choices, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.cache_path)
+        except (IOError, OSError):
+            pass
+
+
+# The autotuner used by conv_forward_fast. The results are stored in
+# ~/.cache/cs231n/conv_autotune.json, outside the repository, unless
+# CS231N_CONV_AUTOTUNE_CACHE gives another path.
+conv_autotuner = ConvAutotuner(os.environ.get(
+    'CS231N_CONV_AUTOTUNE_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'cs231n',
+                 'conv_autotune.json')))
+
+
+def conv_forward_fast(x, w, b, conv_param):
+    """
+    A fast implementation of the forward pass for a convolutional layer,
+    using the algorithm conv_autotuner picks for its geometry.
+
+    The first call for a geometry that is not in the autotuner's cache runs
+    the benchmark, i.e. several forward and backward passes of every
+    algorithm, so make one untimed call before timing this function.
+    """
+    algo = conv_autotuner.choose(x, w, b, conv_param)
+    out, cache = CONV_ALGORITHMS[algo][0](x, w, b, conv_param)
+    return out, (algo, cache)
+
+
+def conv_backward_fast(dout, cache):
+    """
+    A fast implementation of the backward pass for a convolutional layer,
+    using the algorithm that generated the cache.
+    """
+    algo, real_cache = cache
+    return CONV_ALGORITHMS[algo][1](dout, real_cache)
 
 
 def max_pool_forward_fast(x, pool_param):
@@ -262,7 +531,8 @@ def max_pool_forward_im2col(x, pool_param):
     out_width = (W - pool_width) // stride + 1
 
     x_split = x.reshape(N * C, 1, H, W)
-    x_cols = im2col(x_split, pool_height, pool_width, padding=0, stride=stride)
+    x_cols = im2col_indices(x_split, pool_height, pool_width, padding=0,
+                            stride=stride)
     x_cols_argmax = np.argmax(x_cols, axis=0)
     x_cols_max = x_cols[x_cols_argmax, np.arange(x_cols.shape[1])]
     out = x_cols_max.reshape(out_height, out_width, N, C).transpose(2, 3, 0, 1)
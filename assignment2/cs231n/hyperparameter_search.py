@@ -0,0 +1,217 @@
+"""
+Process-parallel hyperparameter search.
+
+The searches below train many configurations of a model at once, each in its
+own worker process. The training function is supplied by the caller and must
+have the signature
+
+    def train_fn(config, data, budget, state):
+        ...
+        return result
+
+Inputs:
+  - config: Dictionary of hyperparameters, e.g. {'learning_rate': 1e-3,
+    'reg': 0.5}.
+  - data: Dictionary of arrays, e.g. {'X_train': ..., 'y_train': ...,
+    'X_val': ..., 'y_val': ...}. In the workers these are read-only memmaps
+    of a single copy of the data written to disk once by the parent process,
+    so the data is shared through the page cache instead of being pickled to
+    every worker.
+  - budget: The amount of training to do, in whatever unit train_fn chooses
+    (for example num_iters or num_epochs), or None.
+  - state: None, or the 'state' entry of the result of a previous call for the
+    same config, so that successive_halving can resume training.
+
+Returns:
+  - result: Dictionary that must contain 'val_acc_history', a list of
+    validation accuracies such as the one returned by TwoLayerNet.train or
+    stored in Solver.val_acc_history. It may contain 'state' (e.g. the model)
+    and anything else; it is sent back to the parent process, so it should be
+    picklable.
+
+For example, for a FullyConnectedNet trained by a Solver:
+
+    def train_fc_net(config, data, budget, state):
+        model = state or FullyConnectedNet([100, 100], reg=config['reg'])
+        solver = Solver(model, data, num_epochs=budget, verbose=False,
+                        update_rule='adam',
+                        optim_config={'learning_rate': config['lr']})
+        solver.train()
+        return {'val_acc_history': solver.val_acc_history, 'state': model}
+
+Note that the state should not hold a reference to the data (as the Solver
+does), since it is pickled back to the parent process.
+
+Worker processes are forked, so train_fn may be defined in a notebook. Each
+worker limits its BLAS library to blas_threads threads with threadpoolctl, so
+that num_workers workers do not oversubscribe the cores; without threadpoolctl
+a warning is issued and the BLAS thread count is left unchanged.
+"""
+from __future__ import print_function, division
+from builtins import range
+from builtins import object
+import multiprocessing
+import os
+import shutil
+import tempfile
+import warnings
+
+import numpy as np
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+
+def sample_configs(space, num_configs, seed=None):
+    """
+    Draw random configurations for random search.
+
+    Inputs:
+    - space: Dictionary mapping each hyperparameter name to either a list of
+      values, one of which is chosen uniformly, a tuple (low, high) sampled
+      uniformly, or a tuple (low, high, 'log') sampled log-uniformly.
+    - num_configs: Number of configurations to draw.
+    - seed: Optional seed of the random number generator.
+
+    Returns:
+    - configs: List of num_configs dictionaries.
+    """
+    rng = np.random.RandomState(seed)
+    configs = []
+    for _ in range(num_configs):
+        config = {}
+        for name, values in sorted(space.items()):
+            if isinstance(values, list):
+                config[name] = values[rng.randint(len(values))]
+            elif len(values) == 3 and values[2] == 'log':
+                config[name] = float(np.exp(rng.uniform(np.log(values[0]),
+                                                        np.log(values[1]))))
+            else:
+                config[name] = float(rng.uniform(values[0], values[1]))
+        configs.append(config)
+    return configs
+
+
+def search(train_fn, data, configs, budget=None, num_workers=None,
+           blas_threads=1):
+    """
+    Train every configuration in a pool of worker processes.
+
+    Inputs:
+    - train_fn: Training function; see the module documentation.
+    - data: Dictionary of arrays shared with the workers.
+    - configs: List of configuration dictionaries, e.g. from sample_configs or
+      a grid.
+    - budget: Budget passed to every call of train_fn.
+    - num_workers: Number of processes; defaults to the number of CPUs.
+    - blas_threads: Number of BLAS threads in each worker.
+
+    Yields tuples (config, result) as soon as each configuration finishes, so
+    results stream back in completion order.
+    """
+    with _WorkerPool(data, num_workers, blas_threads) as pool:
+        tasks = [(train_fn, config, budget, None) for config in configs]
+        for config, result in pool.imap_unordered(_run_task, tasks):
+            yield config, result
+
+
+def successive_halving(train_fn, data, configs, min_budget, max_budget,
+                       eta=3, num_workers=None, blas_threads=1):
+    """
+    Early-stopping search by successive halving.
+
+    All configurations are first trained with min_budget. Only the best 1 / eta
+    of them, ranked by their best validation accuracy so far, are trained
+    further with eta times the budget, and so on until max_budget is reached.
+    Poor configurations are thus stopped early and most of the compute goes to
+    the promising ones. When train_fn returns a 'state', the next round
+    resumes from it with the additional budget only.
+
+    Inputs:
+    - train_fn, data, configs, num_workers, blas_threads: See search.
+    - min_budget: Budget of the first round.
+    - max_budget: Largest total budget given to a configuration.
+    - eta: Factor by which the number of configurations shrinks, and the
+      budget grows, from one round to the next.
+
+    Yields tuples (round, config, result) as soon as each training run
+    finishes; round counts from 0.
+    """
+    states = [None] * len(configs)
+    survivors = list(range(len(configs)))
+    total_budget = 0
+    budget = min_budget
+    round_num = 0
+    with _WorkerPool(data, num_workers, blas_threads) as pool:
+        while survivors:
+            budget = min(budget, max_budget)
+            scores = {}
+            tasks = []
+            for i in survivors:
+                # a resumed run only needs the budget it has not had yet
+                run_budget = budget if states[i] is None else budget - total_budget
+                tasks.append((train_fn, configs[i], run_budget, states[i], i))
+            for i, (config, result) in pool.imap_unordered(_run_indexed_task,
+                                                           tasks):
+                states[i] = result.get('state')
+                scores[i] = max(result['val_acc_history'])
+                yield round_num, config, result
+
+            if budget >= max_budget:
+                break
+            num_keep = max(len(survivors) // eta, 1)
+            survivors = sorted(survivors, key=lambda i: -scores[i])[:num_keep]
+            total_budget = budget
+            budget *= eta
+            round_num += 1
+
+
+class _WorkerPool(object):
+    """
+    A multiprocessing pool whose workers memory-map the arrays of data from a
+    temporary directory, which is removed when the pool is closed.
+    """
+
+    def __init__(self, data, num_workers, blas_threads):
+        if threadpool_limits is None:
+            warnings.warn('threadpoolctl is not installed, so the BLAS thread '
+                          'count of the search workers cannot be limited')
+        self.data_dir = tempfile.mkdtemp(prefix='search_')
+        for name, value in data.items():
+            np.save(os.path.join(self.data_dir, name + '.npy'), value)
+        self.pool = multiprocessing.get_context('fork').Pool(
+            num_workers, initializer=_init_worker,
+            initargs=(self.data_dir, sorted(data), blas_threads))
+
+    def __enter__(self):
+        return self.pool
+
+    def __exit__(self, *args):
+        self.pool.terminate()
+        self.pool.join()
+        shutil.rmtree(self.data_dir, True)
+
+
+# The shared data of a search worker process, set by _init_worker.
+_worker_data = None
+
+
+def _init_worker(data_dir, names, blas_threads):
+    global _worker_data
+    if threadpool_limits is not None:
+        threadpool_limits(blas_threads)
+    _worker_data = {name: np.load(os.path.join(data_dir, name + '.npy'),
+                                  mmap_mode='r')
+                    for name in names}
+
+
+def _run_task(task):
+    train_fn, config, budget, state = task
+    return config, train_fn(config, _worker_data, budget, state)
+
+
+def _run_indexed_task(task):
+    i = task[-1]
+    return i, _run_task(task[:-1])
@@ -1,14 +1,35 @@
 from builtins import range
+from functools import lru_cache
 import numpy as np
 
 
-def get_im2col_indices(x_shape, field_height, field_width, padding=1, stride=1):
-    # First figure out what the size of the output should be
+def get_im2col_indices(x_shape, field_height, field_width, padding=1, stride=1,
+                       flat=False):
+    """
+    Indices of the im2col columns of a zero-padded input of shape x_shape.
+
+    The indices only depend on the layer geometry, so they are built once per
+    (C, H, W, field size, padding, stride) and then served from an LRU cache.
+    The returned int32 arrays are shared between calls and read-only.
+
+    If flat is False, returns the tuple (k, i, j) such that
+    x_padded[:, k, i, j] has shape (N, C * field_height * field_width,
+    out_height * out_width). If flat is True, returns a single array of that
+    trailing shape holding linear indices into one flattened padded image
+    x_padded[n], so the gather is one np.take and the scatter one np.bincount.
+    """
     N, C, H, W = x_shape
+    return _im2col_indices(C, H, W, field_height, field_width, padding, stride,
+                           flat)
+
+
+@lru_cache(maxsize=64)
+def _im2col_indices(C, H, W, field_height, field_width, padding, stride, flat):
+    # First figure out what the size of the output should be
     assert (H + 2 * padding - field_height) % stride == 0
-    assert (W + 2 * padding - field_height) % stride == 0
-    out_height = (H + 2 * padding - field_height) / stride + 1
-    out_width = (W + 2 * padding - field_width) / stride + 1
+    assert (W + 2 * padding - field_width) % stride == 0
+    out_height = (H + 2 * padding - field_height) // stride + 1
+    out_width = (W + 2 * padding - field_width) // stride + 1
 
     i0 = np.repeat(np.arange(field_height), field_width)
     i0 = np.tile(i0, C)
@@ -20,7 +41,15 @@ def get_im2col_indices(x_shape, field_height, field_width, padding=1, stride=1):
 
     k = np.repeat(np.arange(C), field_height * field_width).reshape(-1, 1)
 
-    return (k, i, j)
+    if flat:
+        W_padded = W + 2 * padding
+        indices = ((k * (H + 2 * padding) + i) * W_padded + j,)
+    else:
+        indices = (k, i, j)
+    indices = tuple(idx.astype(np.int32) for idx in indices)
+    for idx in indices:
+        idx.setflags(write=False)
+    return indices[0] if flat else indices
 
 
 def im2col_indices(x, field_height, field_width, padding=1, stride=1):
@@ -29,10 +58,10 @@ def im2col_indices(x, field_height, field_width, padding=1, stride=1):
     p = padding
     x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
 
-    k, i, j = get_im2col_indices(x.shape, field_height, field_width, padding,
-                                 stride)
+    idx = get_im2col_indices(x.shape, field_height, field_width, padding,
+                             stride, flat=True)
 
-    cols = x_padded[:, k, i, j]
+    cols = x_padded.reshape(x.shape[0], -1).take(idx, axis=1)
     C = x.shape[1]
     cols = cols.transpose(1, 2, 0).reshape(field_height * field_width * C, -1)
     return cols
@@ -40,15 +69,18 @@ def im2col_indices(x, field_height, field_width, padding=1, stride=1):
 
 def col2im_indices(cols, x_shape, field_height=3, field_width=3, padding=1,
                    stride=1):
-    """ An implementation of col2im based on fancy indexing and np.add.at """
+    """ An implementation of col2im based on linear indices and np.bincount """
     N, C, H, W = x_shape
     H_padded, W_padded = H + 2 * padding, W + 2 * padding
-    x_padded = np.zeros((N, C, H_padded, W_padded), dtype=cols.dtype)
-    k, i, j = get_im2col_indices(x_shape, field_height, field_width, padding,
-                                 stride)
-    cols_reshaped = cols.reshape(C * field_height * field_width, -1, N)
-    cols_reshaped = cols_reshaped.transpose(2, 0, 1)
-    np.add.at(x_padded, (slice(None), k, i, j), cols_reshaped)
+    idx = get_im2col_indices(x_shape, field_height, field_width, padding,
+                             stride, flat=True)
+    # cols[r, l * N + n] goes to the linear index idx[r, l] of image n
+    plane = C * H_padded * W_padded
+    cols_indices = idx[:, :, np.newaxis] + plane * np.arange(N)
+    x_padded = np.bincount(cols_indices.ravel(), weights=cols.ravel(),
+                           minlength=N * plane)
+    x_padded = x_padded.reshape(N, C, H_padded, W_padded).astype(cols.dtype,
+                                                                 copy=False)
     if padding == 0:
         return x_padded
     return x_padded[:, :, padding:-padding, padding:-padding]
@@ -1,6 +1,7 @@
 import numpy as np
 cimport numpy as np
 cimport cython
+from cython.parallel import prange
 
 # DTYPE = np.float64
 # ctypedef np.float64_t DTYPE_t
@@ -9,62 +10,83 @@ ctypedef fused DTYPE_t:
     np.float32_t
     np.float64_t
 
+# The inner loops below release the GIL and are parallelized with OpenMP
+# (see setup.py); the number of threads follows OMP_NUM_THREADS. Every thread
+# owns a disjoint part of the output, so there are no write races.
+
+# Number of images handled together by one col2im_cython task.
+cdef enum:
+    COL2IM_BLOCK = 16
+
 def im2col_cython(np.ndarray[DTYPE_t, ndim=4] x, int field_height,
-                  int field_width, int padding, int stride):
+                  int field_width, int padding, int stride, cols=None):
+    """
+    If cols is given, it must be a C-contiguous array of the output shape and
+    dtype; the columns are written into it instead of a new array. With
+    padding=0, x is used without copying when it is C-contiguous.
+    """
     cdef int N = x.shape[0]
     cdef int C = x.shape[1]
     cdef int H = x.shape[2]
     cdef int W = x.shape[3]
-    
-    cdef int HH = (H + 2 * padding - field_height) / stride + 1
-    cdef int WW = (W + 2 * padding - field_width) / stride + 1
-
-    cdef int p = padding
-    cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.pad(x,
-            ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
-
-    cdef np.ndarray[DTYPE_t, ndim=2] cols = np.zeros(
-            (C * field_height * field_width, N * HH * WW),
-            dtype=x.dtype)
 
-    # Moving the inner loop to a C function with no bounds checking works, but does
-    # not seem to help performance in any measurable way.
+    cdef int HH = (H + 2 * padding - field_height) // stride + 1
+    cdef int WW = (W + 2 * padding - field_width) // stride + 1
 
-    im2col_cython_inner(cols, x_padded, N, C, H, W, HH, WW,
+    cdef int p = padding
+    cdef DTYPE_t[:, :, :, ::1] x_padded
+    if p > 0:
+        x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
+    else:
+        x_padded = np.ascontiguousarray(x)
+
+    cols_shape = (C * field_height * field_width, N * HH * WW)
+    if cols is None:
+        cols = np.empty(cols_shape, dtype=x.dtype)
+    elif cols.shape != cols_shape:
+        raise ValueError('cols must have shape %s' % (cols_shape,))
+    cdef DTYPE_t[:, ::1] cols_view = cols
+
+    im2col_cython_inner(cols_view, x_padded, N, C, H, W, HH, WW,
                         field_height, field_width, padding, stride)
     return cols
 
 
 @cython.boundscheck(False)
-cdef int im2col_cython_inner(np.ndarray[DTYPE_t, ndim=2] cols,
-                             np.ndarray[DTYPE_t, ndim=4] x_padded,
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int im2col_cython_inner(DTYPE_t[:, ::1] cols,
+                             DTYPE_t[:, :, :, ::1] x_padded,
                              int N, int C, int H, int W, int HH, int WW,
-                             int field_height, int field_width, int padding, int stride) except? -1:
+                             int field_height, int field_width, int padding,
+                             int stride) except -1 nogil:
     cdef int c, ii, jj, row, yy, xx, i, col
 
-    for c in range(C):
+    # each thread fills whole rows of cols, which are written contiguously
+    for row in prange(C * field_height * field_width, schedule='static'):
+        c = row // (field_height * field_width)
+        ii = row // field_width % field_height
+        jj = row % field_width
+        col = 0
         for yy in range(HH):
             for xx in range(WW):
-                for ii in range(field_height):
-                    for jj in range(field_width):
-                        row = c * field_width * field_height + ii * field_height + jj
-                        for i in range(N):
-                            col = yy * WW * N + xx * N + i
-                            cols[row, col] = x_padded[i, c, stride * yy + ii, stride * xx + jj]
+                for i in range(N):
+                    cols[row, col] = x_padded[i, c, stride * yy + ii, stride * xx + jj]
+                    col = col + 1
+    return 0
 
 
 
 def col2im_cython(np.ndarray[DTYPE_t, ndim=2] cols, int N, int C, int H, int W,
                   int field_height, int field_width, int padding, int stride):
-    cdef np.ndarray x = np.empty((N, C, H, W), dtype=cols.dtype)
-    cdef int HH = (H + 2 * padding - field_height) / stride + 1
-    cdef int WW = (W + 2 * padding - field_width) / stride + 1
-    cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.zeros((N, C, H + 2 * padding, W + 2 * padding),
-                                        dtype=cols.dtype)
-
-    # Moving the inner loop to a C-function with no bounds checking improves
-    # performance quite a bit for col2im.
-    col2im_cython_inner(cols, x_padded, N, C, H, W, HH, WW, 
+    cdef int HH = (H + 2 * padding - field_height) // stride + 1
+    cdef int WW = (W + 2 * padding - field_width) // stride + 1
+    x_padded = np.zeros((N, C, H + 2 * padding, W + 2 * padding),
+                        dtype=cols.dtype)
+    cdef DTYPE_t[:, ::1] cols_view = np.ascontiguousarray(cols)
+    cdef DTYPE_t[:, :, :, ::1] x_padded_view = x_padded
+
+    col2im_cython_inner(cols_view, x_padded_view, N, C, H, W, HH, WW,
                         field_height, field_width, padding, stride)
     if padding > 0:
         return x_padded[:, :, padding:-padding, padding:-padding]
@@ -72,50 +94,67 @@ def col2im_cython(np.ndarray[DTYPE_t, ndim=2] cols, int N, int C, int H, int W,
 
 
 @cython.boundscheck(False)
-cdef int col2im_cython_inner(np.ndarray[DTYPE_t, ndim=2] cols,
-                             np.ndarray[DTYPE_t, ndim=4] x_padded,
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int col2im_cython_inner(DTYPE_t[:, ::1] cols,
+                             DTYPE_t[:, :, :, ::1] x_padded,
                              int N, int C, int H, int W, int HH, int WW,
-                             int field_height, int field_width, int padding, int stride) except? -1:
-    cdef int c, ii, jj, row, yy, xx, i, col
-
-    for c in range(C):
+                             int field_height, int field_width, int padding,
+                             int stride) except -1 nogil:
+    cdef int task, c, n0, n1, ii, jj, row, yy, xx, i, col
+    cdef int num_blocks = (N + COL2IM_BLOCK - 1) // COL2IM_BLOCK
+
+    # each thread accumulates into the (n, c) planes of x_padded of one channel
+    # and a block of images, so no two threads write to the same plane; the
+    # innermost loop reads a contiguous run of cols
+    for task in prange(C * num_blocks, schedule='static'):
+        c = task // num_blocks
+        n0 = task % num_blocks * COL2IM_BLOCK
+        n1 = min(n0 + COL2IM_BLOCK, N)
         for ii in range(field_height):
             for jj in range(field_width):
-                row = c * field_width * field_height + ii * field_height + jj
+                row = c * field_width * field_height + ii * field_width + jj
                 for yy in range(HH):
                     for xx in range(WW):
-                        for i in range(N):
-                            col = yy * WW * N + xx * N + i
-                            x_padded[i, c, stride * yy + ii, stride * xx + jj] += cols[row, col]
+                        col = (yy * WW + xx) * N
+                        for i in range(n0, n1):
+                            x_padded[i, c, stride * yy + ii, stride * xx + jj] += cols[row, col + i]
+    return 0
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef col2im_6d_cython_inner(np.ndarray[DTYPE_t, ndim=6] cols,
-                            np.ndarray[DTYPE_t, ndim=4] x_padded,
-                            int N, int C, int H, int W, int HH, int WW,
-                            int out_h, int out_w, int pad, int stride):
-
-    cdef int c, hh, ww, n, h, w
-    for n in range(N):
-        for c in range(C):
-            for hh in range(HH):
-                for ww in range(WW):
-                    for h in range(out_h):
-                        for w in range(out_w):
-                            x_padded[n, c, stride * h + hh, stride * w + ww] += cols[c, hh, ww, n, h, w]
-    
+@cython.cdivision(True)
+cdef int col2im_6d_cython_inner(DTYPE_t[:, :, :, :, :, ::1] cols,
+                                DTYPE_t[:, :, :, ::1] x_padded,
+                                int N, int C, int H, int W, int HH, int WW,
+                                int out_h, int out_w, int pad, int stride) except -1 nogil:
+
+    cdef int nc, c, hh, ww, n, h, w
+
+    # each thread accumulates into whole (n, c) planes of x_padded
+    for nc in prange(N * C, schedule='static'):
+        n = nc // C
+        c = nc % C
+        for hh in range(HH):
+            for ww in range(WW):
+                for h in range(out_h):
+                    for w in range(out_w):
+                        x_padded[n, c, stride * h + hh, stride * w + ww] += cols[c, hh, ww, n, h, w]
+    return 0
+
 
 def col2im_6d_cython(np.ndarray[DTYPE_t, ndim=6] cols, int N, int C, int H, int W,
         int HH, int WW, int pad, int stride):
-    cdef np.ndarray x = np.empty((N, C, H, W), dtype=cols.dtype)
-    cdef int out_h = (H + 2 * pad - HH) / stride + 1
-    cdef int out_w = (W + 2 * pad - WW) / stride + 1
-    cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.zeros((N, C, H + 2 * pad, W + 2 * pad),
-                                                  dtype=cols.dtype)
+    cdef int out_h = (H + 2 * pad - HH) // stride + 1
+    cdef int out_w = (W + 2 * pad - WW) // stride + 1
+    x_padded = np.zeros((N, C, H + 2 * pad, W + 2 * pad), dtype=cols.dtype)
+    cdef DTYPE_t[:, :, :, :, :, ::1] cols_view = np.ascontiguousarray(cols)
+    cdef DTYPE_t[:, :, :, ::1] x_padded_view = x_padded
 
-    col2im_6d_cython_inner(cols, x_padded, N, C, H, W, HH, WW, out_h, out_w, pad, stride)
+    col2im_6d_cython_inner(cols_view, x_padded_view, N, C, H, W, HH, WW,
+                           out_h, out_w, pad, stride)
 
     if pad > 0:
         return x_padded[:, :, pad:-pad, pad:-pad]
-    return x_padded 
+    return x_padded
@@ -30,6 +30,44 @@ def affine_relu_backward(dout, cache):
     return dx, dw, db
 
 
+def affine_relu_fused_forward(x, w, b):
+    """
+    Fused affine transform followed by a ReLU, with a compact cache.
+
+    The ReLU is applied in place on the output of the matrix multiplication,
+    and instead of the pre-activation only a bit-packed mask of the units that
+    were active is kept for the backward pass, so the cache holds one
+    activation-sized array (the input, in the dtype of w) instead of two.
+
+    Inputs:
+    - x: Input to the affine layer, of shape (N, d_1, ..., d_k)
+    - w, b: Weights for the affine layer
+
+    Returns a tuple of:
+    - out: Output from the ReLU, of shape (N, M)
+    - cache: Object to give to the backward pass
+    """
+    x = x.astype(w.dtype, copy=False)
+    out = np.dot(x.reshape(x.shape[0], -1), w)
+    out += b
+    # same convention as relu_backward: gradients flow where the input is >= 0
+    mask = np.packbits(out >= 0, axis=1)
+    np.maximum(out, 0, out=out)
+    cache = (x, w, b, mask)
+    return out, cache
+
+
+def affine_relu_fused_backward(dout, cache):
+    """
+    Backward pass for the fused affine-relu layer
+    """
+    x, w, b, mask = cache
+    active = np.unpackbits(mask, axis=1)[:, :dout.shape[1]].view(np.bool_)
+    da = np.where(active, dout, 0)
+    dx, dw, db = affine_backward(da, (x, w, b))
+    return dx, dw, db
+
+
 def conv_relu_forward(x, w, b, conv_param):
     """
     A convenience layer that performs a convolution followed by a ReLU.
@@ -209,22 +209,25 @@ def batchnorm_forward(x, gamma, beta, bn_param):
         #######################################################################
         # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
 
-        # compute the minibatch statistics
-        sample_mean = np.mean(x, axis=0)
-        sample_var = np.var(x, axis=0)
+        # compute the minibatch statistics in a single pass over x,
+        # accumulated in float64 even for float32 data
+        sample_mean, sample_var = _welford_mean_var(x)
+        inv_std = (1 / np.sqrt(sample_var + eps)).astype(x.dtype)
         
         # normalize the incoming data
-        X_normalized = (x - sample_mean)/np.sqrt(sample_var + eps)
+        X_normalized = x - sample_mean.astype(x.dtype)
+        X_normalized *= inv_std
         
         # scale and shift the normalized data
         out = gamma * X_normalized + beta
         
         # update the running averages
-        running_mean = momentum * running_mean + (1 - momentum) * sample_mean
-        running_var = momentum * running_var + (1 - momentum) * sample_var
+        running_mean = momentum * running_mean + (1 - momentum) * sample_mean.astype(x.dtype)
+        running_var = momentum * running_var + (1 - momentum) * sample_var.astype(x.dtype)
         
-        # cache intermediate values for the backward pass
-        cache = (x, sample_mean, sample_var, eps, X_normalized, gamma, beta)
+        # cache intermediate values for the backward pass; x - sample_mean and
+        # the variance can be recovered from these, so x itself is not kept
+        cache = (X_normalized, inv_std, gamma)
 
         # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
         #######################################################################
@@ -286,8 +289,10 @@ def batchnorm_backward(dout, cache):
     # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
 
     # unpack cached intermediate values from the forward pass
-    (x, sample_mean, sample_var, eps, X_normalized, gamma, beta) = cache
-    N = x.shape[0]
+    (X_normalized, inv_std, gamma) = cache
+    N = X_normalized.shape[0]
+    # recover the centered input x - sample_mean
+    x_centered = X_normalized / inv_std
 
     # compute the gradients
     dgamma = np.sum(X_normalized * dout, axis=0)
@@ -296,12 +301,12 @@ def batchnorm_backward(dout, cache):
     # intermediate gradients of the computational graph
     dX_normalized = gamma * dout
     
-    dsample_var = np.sum((x-sample_mean)*dX_normalized, axis=0) * (-0.5/np.sqrt(sample_var + eps)**3)
+    dsample_var = np.sum(x_centered*dX_normalized, axis=0) * (-0.5*inv_std**3)
     
-    dsample_mean = -1/np.sqrt(sample_var + eps) * np.sum(dX_normalized, axis=0) + dsample_var * np.sum(-2*(x - sample_mean), axis=0)/N
+    dsample_mean = -inv_std * np.sum(dX_normalized, axis=0) + dsample_var * np.sum(-2*x_centered, axis=0)/N
     
     # final gradient
-    dx = 1/np.sqrt(sample_var + eps) * dX_normalized + 1/N*dsample_mean + dsample_var * 2*(x - sample_mean)/N
+    dx = inv_std * dX_normalized + 1/N*dsample_mean + dsample_var * 2*x_centered/N
         
     # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
     ###########################################################################
@@ -336,23 +341,22 @@ def batchnorm_backward_alt(dout, cache):
     ###########################################################################
     # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
 
-    # unpack cached intermediate values from the forward pass
-    (x, sample_mean, sample_var, eps, X_normalized, gamma, beta) = cache
-    N = x.shape[0]
+    # unpack cached intermediate values from the forward pass; only the
+    # normalized input and the inverse standard deviation are needed
+    (X_normalized, inv_std, gamma) = cache
+    N = X_normalized.shape[0]
 
     # compute the gradients
     dgamma = np.sum(X_normalized * dout, axis=0)
     dbeta = np.sum(dout, axis=0)
     
-    # intermediate gradients of the computational graph
+    # gradient with respect to the normalized input, then with respect to x:
+    # dx = inv_std / N * (N * dXn - sum(dXn) - Xn * sum(dXn * Xn))
     dX_normalized = gamma * dout
-    
-    dsample_var = -0.5 * np.sum(X_normalized*dX_normalized, axis=0) * 1/(sample_var + eps)
-    
-    dsample_mean = - np.sqrt(sample_var + eps) * ( 1/(sample_var + eps) * np.sum(dX_normalized, axis=0) + 2/N * dsample_var * np.sum(X_normalized, axis=0) )
-    
-    # final gradient
-    dx = 1/np.sqrt(sample_var + eps) * dX_normalized + 1/N*dsample_mean + dsample_var * 2*np.sqrt(sample_var + eps)*X_normalized/N
+    dx = N * dX_normalized
+    dx -= np.sum(dX_normalized, axis=0)
+    dx -= X_normalized * np.sum(dX_normalized * X_normalized, axis=0)
+    dx *= inv_std / N
         
     # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
     ###########################################################################
@@ -362,6 +366,47 @@ def batchnorm_backward_alt(dout, cache):
     return dx, dgamma, dbeta
 
 
+def _welford_mean_var(x, block_elems=2**20):
+    """
+    Mean and (uncorrected) variance of x for each index of axis 1, reduced
+    over axis 0 and any trailing axes, computed in a single pass over blocks
+    of x[i] with float64 accumulation.
+
+    The statistics of each block are merged into the running ones with the
+    parallel form of Welford's algorithm (Chan et al.), which stays accurate
+    without a second pass over the data, and only one block is converted to
+    float64 at a time.
+
+    Inputs:
+    - x: Data of shape (N, D) or (N, D, ...), e.g. (N, C, H, W)
+    - block_elems: Approximate number of elements per block
+
+    Returns a tuple of:
+    - mean: float64 array of shape (D,)
+    - var: float64 array of shape (D,)
+    """
+    D = x.shape[1]
+    axes = (0,) + tuple(range(2, x.ndim))
+    shape = (1, D) + (1,) * (x.ndim - 2)
+    block_size = max(1, block_elems // max(x[:1].size, 1))
+    count = 0
+    mean = np.zeros(D)
+    m2 = np.zeros(D)
+    for start in range(0, x.shape[0], block_size):
+        block = x[start:start + block_size].astype(np.float64)
+        block_count = block.size // D
+        block_mean = block.mean(axis=axes)
+        block -= block_mean.reshape(shape)
+        block_m2 = np.square(block, out=block).sum(axis=axes)
+
+        total = count + block_count
+        delta = block_mean - mean
+        mean += delta * (block_count / total)
+        m2 += block_m2 + delta**2 * (count * block_count / total)
+        count = total
+    return mean, m2 / count
+
+
 def layernorm_forward(x, gamma, beta, ln_param):
     """
     Forward pass for layer normalization.
@@ -486,7 +531,8 @@ def dropout_forward(x, dropout_param):
     Outputs:
     - out: Array of the same shape as x.
     - cache: tuple (dropout_param, mask). In training mode, mask is the dropout
-      mask that was used to multiply the input; in test mode, mask is None.
+      mask that was used to multiply the input, bit-packed with np.packbits so
+      it takes one bit per element; in test mode, mask is None.
 
     NOTE: Please implement **inverted** dropout, not the vanilla version of dropout.
     See http://cs231n.github.io/neural-networks-2/#reg for more details.
@@ -509,9 +555,13 @@ def dropout_forward(x, dropout_param):
         #######################################################################
         # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
 
-        mask = np.random.rand(*x.shape) <= p
-        # inverted dropout
-        out = 1/p * np.where(mask, x, 0)
+        # draw the mask from a stream keyed by the global random state, so
+        # np.random.seed still makes the masks reproducible
+        keep = _dropout_keep_mask(x.shape, p, np.random.randint(2**31), x.dtype)
+        mask = np.packbits(keep)
+        # inverted dropout, scaled in place
+        out = x * keep
+        out *= 1/p
 
         # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
         #######################################################################
@@ -556,7 +606,9 @@ def dropout_backward(dout, cache):
         
         p = dropout_param['p']
         
-        dx = 1/p * np.where(mask, dout, 0)
+        keep = np.unpackbits(mask)[:dout.size].reshape(dout.shape)
+        dx = dout * keep
+        dx *= 1/p
 
         # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
         #######################################################################
@@ -567,6 +619,21 @@ def dropout_backward(dout, cache):
     return dx
 
 
+def _dropout_keep_mask(shape, p, key, dtype):
+    """
+    Boolean mask of the given shape whose entries are True with probability p.
+
+    The uniform numbers come from a counter-based Philox stream keyed by key,
+    drawn directly in float32 for float32 activations. numpy versions without
+    np.random.Generator fall back to a RandomState seeded with key.
+    """
+    if hasattr(np.random, 'Philox'):
+        rng = np.random.Generator(np.random.Philox(key))
+        dtype = np.float32 if dtype == np.float32 else np.float64
+        return rng.random(shape, dtype=dtype) < p
+    return np.random.RandomState(key).random_sample(shape) < p
+
+
 def conv_forward_naive(x, w, b, conv_param):
     """
     A naive implementation of the forward pass for a convolutional layer.
@@ -900,16 +967,42 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
     ###########################################################################
     # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
 
-    # swap dimensions
-    X_swapped = np.swapaxes(x, -1, 1) # (N, W, H, C)
-    # reshape to be able to use the vanilla version of batch normalization
-    X_flatten = np.reshape(X_swapped, (-1, X_swapped.shape[-1])) # (N*W*H, C)
-    # spatial batch normalization
-    out_flatten, cache = batchnorm_forward(X_flatten, gamma, beta, bn_param)
-    # reshape to match the input size
-    out_swapped = np.reshape(out_flatten, X_swapped.shape) # (N, W, H, C)
-    # re-swap dimensions
-    out = np.swapaxes(out_swapped, -1, 1) # (N, C, H, W)
+    # normalize directly in the (N, C, H, W) layout: the statistics are
+    # reduced over axes (0, 2, 3) and the per-channel values are broadcast,
+    # so the activations are never transposed into an (N*H*W, C) copy
+    mode = bn_param['mode']
+    eps = bn_param.get('eps', 1e-5)
+    momentum = bn_param.get('momentum', 0.9)
+
+    C = x.shape[1]
+    shape = (1, C, 1, 1)
+    running_mean = bn_param.get('running_mean', np.zeros(C, dtype=x.dtype))
+    running_var = bn_param.get('running_var', np.zeros(C, dtype=x.dtype))
+
+    if mode == 'train':
+        sample_mean, sample_var = _welford_mean_var(x)
+        inv_std = (1 / np.sqrt(sample_var + eps)).astype(x.dtype)
+
+        X_normalized = x - sample_mean.astype(x.dtype).reshape(shape)
+        X_normalized *= inv_std.reshape(shape)
+
+        running_mean = momentum * running_mean + (1 - momentum) * sample_mean.astype(x.dtype)
+        running_var = momentum * running_var + (1 - momentum) * sample_var.astype(x.dtype)
+
+        # same compact cache as batchnorm_forward
+        cache = (X_normalized, inv_std, gamma)
+    elif mode == 'test':
+        X_normalized = x - running_mean.reshape(shape)
+        X_normalized /= np.sqrt(running_var + eps).reshape(shape)
+    else:
+        raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+
+    # scale and shift the normalized data
+    out = X_normalized * gamma.reshape(shape)
+    out += beta.reshape(shape)
+
+    bn_param['running_mean'] = running_mean
+    bn_param['running_var'] = running_var
 
     # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
     ###########################################################################
@@ -943,16 +1036,22 @@ def spatial_batchnorm_backward(dout, cache):
     ###########################################################################
     # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
 
-    # swap dimensions
-    dout_swapped = np.swapaxes(dout, -1, 1) # (N, W, H, C)
-    # reshape to be able to use the vanilla version of batch normalization
-    dout_flatten = np.reshape(dout_swapped, (-1, dout_swapped.shape[-1])) # (N*W*H, C)
-    # spatial batch normalization
-    dx_flatten, dgamma, dbeta = batchnorm_backward(dout_flatten, cache)
-    # reshape to match the input size
-    dx_swapped = np.reshape(dx_flatten, dout_swapped.shape) # (N, W, H, C)
-    # re-swap dimensions
-    dx = np.swapaxes(dx_swapped, -1, 1) # (N, C, H, W)
+    # unpack cached intermediate values from the forward pass
+    (X_normalized, inv_std, gamma) = cache
+    C = dout.shape[1]
+    M = dout.size // C # N*H*W values per channel
+    shape = (1, C, 1, 1)
+
+    # reduce over axes (0, 2, 3) in the (N, C, H, W) layout
+    dbeta = np.sum(dout, axis=(0, 2, 3))
+    dgamma = np.einsum('nchw,nchw->c', X_normalized, dout)
+
+    # same closed form as batchnorm_backward_alt, using
+    # sum(dXn) = gamma * dbeta and sum(dXn * Xn) = gamma * dgamma
+    scale = gamma * inv_std
+    dx = dout * scale.reshape(shape)
+    dx -= (scale * dbeta / M).reshape(shape)
+    dx -= X_normalized * (scale * dgamma / M).reshape(shape)
     
     # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
     ###########################################################################
@@ -1,11 +1,24 @@
+import sys
 from distutils.core import setup
 from distutils.extension import Extension
 from Cython.Build import cythonize
 import numpy
 
+# The im2col / col2im loops are parallelized with OpenMP. Apple's clang does
+# not support -fopenmp out of the box, so on macOS the extension is built
+# without it and the loops run on a single thread.
+if sys.platform == 'win32':
+  openmp_compile_args, openmp_link_args = ['/openmp'], []
+elif sys.platform == 'darwin':
+  openmp_compile_args, openmp_link_args = [], []
+else:
+  openmp_compile_args, openmp_link_args = ['-fopenmp'], ['-fopenmp']
+
 extensions = [
   Extension('im2col_cython', ['im2col_cython.pyx'],
-            include_dirs = [numpy.get_include()]
+            include_dirs = [numpy.get_include()],
+            extra_compile_args = openmp_compile_args,
+            extra_link_args = openmp_link_args,
   ),
 ]
 